@@ -0,0 +1,60 @@
+# Run the local cover detector (without rembg) on the example photos:
+# print its confidence and time, and save the photos with the found cover outlined.
+#
+# Run from the repository root:
+#   python examples/find_cover/check_detect_cover.py --output detect_cover
+#
+# Compare the confidence with LOCAL_COVER_CONFIDENCE and LOCAL_COVER_BUSY_CONFIDENCE
+# of the bot: covers above them are used without asking rembg service.
+
+import argparse # For command line options
+import glob # For finding the example photos
+import os # For paths
+import re # For photo file names
+import sys # For the import path
+import time # For measuring time
+
+import cv2 # For image processing
+import numpy as np # For arrays processing
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(EXAMPLES_DIR, ".."))
+import modules.cover_geometry as geo # The detector under test
+
+DEFAULT_IMAGES = [os.path.join(EXAMPLES_DIR, "find_cover"), os.path.join(EXAMPLES_DIR, "find_cover2")]
+PHOTO_NAME = re.compile(r"^(cover)?\d+\.jpg$") # Source photos in the examples directories
+
+# =========================================================
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the local cover detector on the example photos")
+    parser.add_argument("images", nargs="*", default=DEFAULT_IMAGES, help="photos or directories with .jpg photos (default: examples/find_cover and find_cover2)")
+    parser.add_argument("--output", help="directory for the photos with the cover outlined")
+    args = parser.parse_args()
+
+    paths = []
+    for path in args.images:
+        if os.path.isdir(path):
+            paths += sorted(f for f in glob.glob(os.path.join(path, "*.jpg")) if PHOTO_NAME.match(os.path.basename(f)))
+        else:
+            paths.append(path)
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+
+    print(f"{'photo':<24} {'confidence':>10} {'ms':>5}")
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        started = time.perf_counter()
+        found = geo.detect_cover(data)
+        elapsed = time.perf_counter() - started
+        name = os.path.join(os.path.basename(os.path.dirname(path)), os.path.basename(path))
+        confidence = f"{found[1]:.3f}" if found else "-"
+        print(f"{name:<24} {confidence:>10} {elapsed * 1000:>5.0f}")
+        if args.output:
+            image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+            if found:
+                cv2.polylines(image, [found[0].astype(np.int32)], True, (0, 0, 255), 4)
+            cv2.imwrite(os.path.join(args.output, name.replace(os.sep, "_")), image)
+
+if __name__ == "__main__":
+    main()
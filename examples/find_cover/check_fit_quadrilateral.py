@@ -0,0 +1,156 @@
+# Regression check and micro-benchmark of the cover quadrilateral fitting.
+#
+# Compares modules/cover_geometry.fit_quadrilateral with the original linear
+# search of epsilon on the contours of the example photos, and fails if the
+# chosen corners change. Run from the repository root:
+#   python examples/find_cover/check_fit_quadrilateral.py
+#
+# Where the original found no 4-vertex approximation and fell back to
+# minAreaRect, the new fitting takes the corners on the convex hull. There the
+# check compares how well both quadrilaterals cover the contour (IoU), and
+# fails if the new corners are worse.
+#
+# Masks of the photos are made by Otsu threshold of the photo, or by rembg
+# with --model (downloads the model on first use, about 1 GB for birefnet-general).
+# Mask images saved in examples/find_cover2 are checked too. Every mask is
+# also checked downscaled, as the rembg service does with REMBG_MAX_SIDE.
+
+import argparse # For command line options
+import glob # For finding the example images
+import os # For paths
+import sys # For the import path and the exit code
+import time # For measuring time
+
+import cv2 # For image processing
+import numpy as np # For arrays processing
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(EXAMPLES_DIR, ".."))
+import modules.cover_geometry as geo # The fitting under test
+
+SCALES = (1.0, 0.5, 0.25) # Mask scales to check
+IOU_TOLERANCE = 0.005 # Loss of IoU with the contour allowed to the convex hull corners
+
+# =========================================================
+# The original fitting: try all epsilons from the smallest one
+def reference_fit_quadrilateral(contour: np.ndarray) -> tuple[np.ndarray, bool]:
+    """Return the corners and whether they came from approxPolyDP (not from minAreaRect)"""
+    quadrilateral = None
+    for factor in np.arange(0.02, 0.15, 0.005):
+        epsilon = factor * cv2.arcLength(contour, True)
+        approx = cv2.approxPolyDP(contour, epsilon, True)
+        if len(approx) == 4:
+            quadrilateral = approx
+            break
+        elif len(approx) < 4 and quadrilateral is None:
+            quadrilateral = approx
+    if quadrilateral is None or len(quadrilateral) != 4:
+        rect_tuple = cv2.minAreaRect(contour)
+        return cv2.boxPoints(rect_tuple).astype(np.int32).reshape(4, 2).astype(np.float32), False
+    return quadrilateral.reshape(4, 2).astype(np.float32), True
+
+# =========================================================
+# Intersection over union of the quadrilateral and the area inside the contour
+def contour_iou(contour: np.ndarray, quadrilateral: np.ndarray) -> float:
+    points = np.vstack([contour.reshape(-1, 2), quadrilateral.reshape(-1, 2)])
+    width, height = (np.ceil(points.max(axis=0)) + 2).astype(int)
+    inside = np.zeros((height, width), np.uint8)
+    cv2.fillPoly(inside, [contour.reshape(-1, 1, 2).astype(np.int32)], 1)
+    quad = np.zeros((height, width), np.uint8)
+    cv2.fillPoly(quad, [np.round(quadrilateral).reshape(-1, 1, 2).astype(np.int32)], 1)
+    union = np.logical_or(inside, quad).sum()
+    return float(np.logical_and(inside, quad).sum() / union) if union else 1.0
+
+# =========================================================
+# Binary masks of the example images: (name, mask)
+def load_masks(model: str | None) -> list[tuple[str, np.ndarray]]:
+    session = None
+    if model:
+        try:
+            from rembg import new_session, remove
+            session = new_session(model)
+        except Exception as e:
+            print(f"rembg model {model} is not available ({e}), using Otsu threshold masks")
+
+    masks = []
+    for path in sorted(glob.glob(os.path.join(EXAMPLES_DIR, "find_cover", "cover*.jpg"))):
+        image = cv2.imread(path)
+        if session is not None:
+            mask = np.asarray(remove(cv2.imencode(".png", image)[1].tobytes(), session=session, only_mask=True, force_return_bytes=False))
+        else:
+            gray = cv2.GaussianBlur(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+            _threshold, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        masks.append((os.path.basename(path), mask))
+    # Masks of the models saved by examples/find_cover2/save_all_rembg_masks.py
+    for path in sorted(glob.glob(os.path.join(EXAMPLES_DIR, "find_cover2", "*.jpg"))):
+        name = os.path.basename(path)
+        if not name[0].isdigit() and name not in ("cover.jpg", "out.jpg"):
+            masks.append((f"find_cover2/{name}", cv2.imread(path, cv2.IMREAD_GRAYSCALE)))
+    # Alpha channel of the cutout in the step-by-step example
+    cutout = cv2.imread(os.path.join(EXAMPLES_DIR, "find_cover", "step-by-step", "debug_00_without_cover.png"), cv2.IMREAD_UNCHANGED)
+    if cutout is not None and cutout.ndim == 3 and cutout.shape[2] == 4:
+        masks.append(("step-by-step/debug_00_without_cover.png", cutout[:, :, 3]))
+    return masks
+
+# =========================================================
+# Contours of all masks at all scales: (name, contour)
+def load_contours(model: str | None) -> list[tuple[str, np.ndarray]]:
+    contours = []
+    for name, mask in load_masks(model):
+        for scale in SCALES:
+            scaled = mask if scale == 1.0 else cv2.resize(mask, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            binary_mask = np.where(scaled > 127, 255, 0).astype(np.uint8)
+            try:
+                contours.append((f"{name} x{scale}", geo.largest_contour(binary_mask)))
+            except ValueError:
+                pass
+    return contours
+
+# =========================================================
+# Mean time of one call of the function over all contours
+def measure(func, contours: list[np.ndarray], repeat: int) -> float:
+    started = time.perf_counter()
+    for _round in range(repeat):
+        for contour in contours:
+            func(contour)
+    return (time.perf_counter() - started) / (repeat * len(contours))
+
+# =========================================================
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Regression check and micro-benchmark of fit_quadrilateral")
+    parser.add_argument("--model", default="", help="rembg model for the masks of the photos, e.g. birefnet-general (default - Otsu threshold)")
+    parser.add_argument("--repeat", type=int, default=20, help="rounds of the micro-benchmark")
+    args = parser.parse_args()
+
+    contours = load_contours(args.model or None)
+    changed = 0
+    fallbacks = 0
+    worse = 0
+    for name, contour in contours:
+        expected, fitted = reference_fit_quadrilateral(contour)
+        actual = geo.fit_quadrilateral(contour)
+        if not fitted:
+            # The original fell back to minAreaRect, the new fitting may find the corners on the convex hull
+            fallbacks += 1
+            shift = np.linalg.norm(geo.order_points(expected) - geo.order_points(actual), axis=1).max()
+            expected_iou = contour_iou(contour, expected)
+            actual_iou = contour_iou(contour, actual)
+            verdict = "same"
+            if actual_iou < expected_iou - IOU_TOLERANCE:
+                worse += 1
+                verdict = "WORSE"
+            elif actual_iou > expected_iou + IOU_TOLERANCE:
+                verdict = "better"
+            print(f"{name}: minAreaRect -> convex hull, corners moved up to {shift:.0f} px, IoU {expected_iou:.3f} -> {actual_iou:.3f} {verdict}")
+        elif not np.array_equal(expected, actual):
+            changed += 1
+            print(f"{name}: CHANGED {expected.tolist()} -> {actual.tolist()}")
+
+    reference_time = measure(reference_fit_quadrilateral, [c for _name, c in contours], args.repeat)
+    new_time = measure(geo.fit_quadrilateral, [c for _name, c in contours], args.repeat)
+    print(f"{len(contours)} contours, {changed} changed, {fallbacks} without 4-vertex approximation ({worse} of them worse)")
+    print(f"fit_quadrilateral: {reference_time * 1e6:.0f} us -> {new_time * 1e6:.0f} us per contour, x{reference_time / new_time:.1f}")
+    sys.exit(1 if changed or worse else 0)
+
+if __name__ == "__main__":
+    main()
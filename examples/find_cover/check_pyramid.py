@@ -0,0 +1,77 @@
+# Accuracy check of the pyramid mode of the cover search: the corners are found
+# on the mask of a downscaled photo, scaled back and refined on the full photo.
+#
+# Synthetic photos with known corners are used: a bright cover with dark text
+# on a noisy background. The mask is made on the downscaled photo by threshold
+# and grown or shrunk by a pixel, as the segmentation model does. Run from the repository root:
+#   python examples/find_cover/check_pyramid.py --max-side 1024
+
+import argparse # For command line options
+import math # For the refine radius
+import os # For paths
+import sys # For the import path and the exit code
+import time # For measuring time
+
+import cv2 # For image processing
+import numpy as np # For arrays processing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import modules.cover_geometry as geo # The geometry under test
+
+# =========================================================
+# Synthetic photo (JPEG) and ordered corners of the cover on it
+def synthetic_photo(rng: np.random.Generator, width: int, height: int) -> tuple[bytes, np.ndarray]:
+    background = rng.normal(90, 15, (height // 8, width // 8)).astype(np.float32)
+    image = np.clip(cv2.resize(background, (width, height)), 0, 255).astype(np.uint8)
+    half = rng.uniform(0.15, 0.22) * min(width, height)
+    corners = np.array([[-1, -1.4], [1, -1.4], [1, 1.4], [-1, 1.4]]) * half
+    angle = rng.uniform(-0.3, 0.3)
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    corners = (corners @ rotation.T + (width / 2, height / 2) + rng.normal(0, half / 12, (4, 2))).astype(np.float32)
+    # Subpixel corners: 4 bits of fraction
+    cv2.fillPoly(image, [np.round(corners * 16).astype(np.int32)], 200, lineType=cv2.LINE_AA, shift=4)
+    for _word in range(30):
+        x, y = corners.mean(axis=0) + rng.normal(0, half / 3, 2)
+        cv2.putText(image, "TEXT", (int(x), int(y)), cv2.FONT_HERSHEY_SIMPLEX, 3, 30, 8)
+    image = cv2.GaussianBlur(image, (0, 0), 1.5)
+    return cv2.imencode(".jpg", cv2.cvtColor(image, cv2.COLOR_GRAY2BGR))[1].tobytes(), geo.order_points(corners)
+
+# =========================================================
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Accuracy check of the pyramid mode of the cover search")
+    parser.add_argument("--max-side", type=int, default=1024, help="longest side of the downscaled photo")
+    parser.add_argument("--refine", type=float, default=3, help="refine radius in pixels of the downscaled photo")
+    parser.add_argument("--size", default="4000x3000", help="size of the full photos")
+    parser.add_argument("--photos", type=int, default=20, help="number of synthetic photos")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+    width, height = (int(v) for v in args.size.split("x"))
+
+    rng = np.random.default_rng(args.seed)
+    kernel = np.ones((3, 3), np.uint8)
+    scaled_errors, refined_errors, refine_times = [], [], []
+    for index in range(args.photos):
+        photo, truth = synthetic_photo(rng, width, height)
+        small, full_size = geo.downscale_jpeg(photo, args.max_side)
+        small_gray = cv2.imdecode(np.frombuffer(small, np.uint8), cv2.IMREAD_GRAYSCALE)
+        mask = np.where(small_gray > 150, 255, 0).astype(np.uint8)
+        mask = cv2.dilate(mask, kernel) if index % 2 else cv2.erode(mask, kernel)
+        size = (small_gray.shape[1], small_gray.shape[0])
+        rect = geo.scale_corners(geo.find_corners(mask), size, full_size)
+        radius = math.ceil(args.refine * full_size[0] / size[0]) + 2
+
+        gray = cv2.imdecode(np.frombuffer(photo, np.uint8), cv2.IMREAD_GRAYSCALE)
+        started = time.perf_counter()
+        refined = geo.refine_corners(gray, rect, radius)
+        refine_times.append(time.perf_counter() - started)
+        scaled_errors.append(float(np.linalg.norm(rect - truth, axis=1).max()))
+        refined_errors.append(float(np.linalg.norm(refined - truth, axis=1).max()))
+
+    print(f"{args.photos} photos {width}x{height}, downscaled to {args.max_side}, refine radius {radius} px")
+    print(f"Scaled corners:  max error mean {np.mean(scaled_errors):.2f} px, worst {np.max(scaled_errors):.2f} px")
+    print(f"Refined corners: max error mean {np.mean(refined_errors):.2f} px, worst {np.max(refined_errors):.2f} px")
+    print(f"Refinement: {np.mean(refine_times) * 1000:.0f} ms per photo")
+    sys.exit(0 if np.mean(refined_errors) <= np.mean(scaled_errors) else 1)
+
+if __name__ == "__main__":
+    main()
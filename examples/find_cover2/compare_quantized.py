@@ -0,0 +1,151 @@
+# Compare the int8-quantized model with the full-precision one on the example photos:
+# mask IoU, error of the cover corners found by the bot geometry, and latency per image.
+#
+# Run from the repository root, for example:
+#   python examples/find_cover2/compare_quantized.py --model birefnet-general --output quantized.json
+#
+# The quantized model is made on first use by homelib-rembg.py (needs the onnx package).
+
+import argparse # For command line options
+import glob # For finding the example photos
+import importlib.util # For loading homelib-rembg.py, its name is not importable
+import json # For saving the results
+import os # For paths
+import re # For photo file names
+import statistics # For averages
+import sys # For the import path
+import time # For measuring latency
+
+import numpy as np # For arrays processing
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, ROOT_DIR)
+import modules.cover_geometry as geo # Same geometry as the bot and the /cover endpoint
+
+PHOTO_NAME = re.compile(r"^(cover)?\d+\.jpg$") # Source photos in the examples directories
+
+# =========================================================
+# Load the rembg service module to use exactly its sessions and image preparation
+def load_service():
+    spec = importlib.util.spec_from_file_location("homelib_rembg", os.path.join(ROOT_DIR, "homelib-rembg.py"))
+    service = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(service)
+    return service
+
+# =========================================================
+# Intersection over union of two binary masks
+def iou(a: np.ndarray, b: np.ndarray) -> float:
+    union = np.logical_or(a, b).sum()
+    if union == 0:
+        return 1.0
+    return float(np.logical_and(a, b).sum() / union)
+
+# =========================================================
+# Corners of the cover in the source photo pixels, or None if there is no cover on the mask
+def corners(binary_mask: np.ndarray, size: tuple[int, int]) -> np.ndarray | None:
+    try:
+        rect = geo.find_corners(np.where(binary_mask, 255, 0).astype(np.uint8))
+    except ValueError:
+        return None
+    height, width = binary_mask.shape
+    return geo.scale_corners(rect, (width, height), size)
+
+# =========================================================
+# Run the model on the prepared image, return the binary mask and the time of inference
+def predict(service, session, img) -> tuple[np.ndarray, float]:
+    started = time.perf_counter()
+    mask = service.predict_batch(session, [img])[0]
+    elapsed = time.perf_counter() - started
+    return np.asarray(mask.convert("L")) > 127, elapsed
+
+# =========================================================
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare the int8-quantized model with the full-precision one")
+    parser.add_argument("images", nargs="*", default=[os.path.dirname(os.path.abspath(__file__))], help="photos or directories with .jpg photos (default: examples/find_cover2)")
+    parser.add_argument("--model", default="birefnet-general", help="full-precision model")
+    parser.add_argument("--quantized", help="quantized model (default: model + -int8)")
+    parser.add_argument("--max-side", type=int, default=0, help="downscale the photos before inference, as REMBG_MAX_SIDE")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="allowed corner error as a fraction of the photo diagonal")
+    parser.add_argument("--output", help="JSON file for the results")
+    args = parser.parse_args()
+
+    service = load_service()
+    quantized_model = args.quantized or args.model + service.QUANTIZED_SUFFIX
+    paths = []
+    for path in args.images:
+        if os.path.isdir(path):
+            # Only source photos, not the masks of save_all_rembg_masks.py saved next to them
+            paths += sorted(f for f in glob.glob(os.path.join(path, "*.jpg")) if PHOTO_NAME.match(os.path.basename(f)))
+        else:
+            paths.append(path)
+
+    print(f"Loading {args.model} and {quantized_model} ...")
+    session = service.create_session(args.model, service.SESSION_SETTINGS)
+    quantized_session = service.create_session(quantized_model, service.SESSION_SETTINGS)
+    service.warmup_session(session)
+    service.warmup_session(quantized_session)
+    options = service.RemoveOptions(only_mask=True, max_side=args.max_side, upscale=False)
+
+    rows = []
+    print(f"{'photo':<12} {'IoU':>6} {'corner px':>9} {'corner %':>8} {'full s':>7} {'int8 s':>7}")
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        img, _full = service.open_image(data, options)
+        size = service.original_size(data)
+        diagonal = float(np.hypot(*size))
+        mask, latency = predict(service, session, img)
+        quantized_mask, quantized_latency = predict(service, quantized_session, img)
+
+        rect = corners(mask, size)
+        quantized_rect = corners(quantized_mask, size)
+        if rect is None or quantized_rect is None:
+            # Cover found by one model only counts as a total miss
+            corner_error = None if rect is None and quantized_rect is None else diagonal
+        else:
+            corner_error = float(np.linalg.norm(rect - quantized_rect, axis=1).max())
+        row = {
+            "photo": os.path.basename(path),
+            "iou": round(iou(mask, quantized_mask), 4),
+            "corner_error_px": round(corner_error, 1) if corner_error is not None else None,
+            "corner_error_rel": round(corner_error / diagonal, 4) if corner_error is not None else None,
+            "latency_sec": round(latency, 4),
+            "quantized_latency_sec": round(quantized_latency, 4),
+        }
+        rows.append(row)
+        error_px = f"{row['corner_error_px']:.1f}" if corner_error is not None else "-"
+        error_rel = f"{row['corner_error_rel'] * 100:.2f}" if corner_error is not None else "-"
+        print(f"{row['photo']:<12} {row['iou']:>6.3f} {error_px:>9} {error_rel:>8} {latency:>7.3f} {quantized_latency:>7.3f}")
+
+    if not rows:
+        parser.error("no images found")
+    errors = [r["corner_error_rel"] for r in rows if r["corner_error_rel"] is not None]
+    summary = {
+        "model": args.model,
+        "quantized_model": quantized_model,
+        "max_side": args.max_side,
+        "photos": len(rows),
+        "iou_mean": round(statistics.mean(r["iou"] for r in rows), 4),
+        "iou_min": min(r["iou"] for r in rows),
+        "corner_error_rel_mean": round(statistics.mean(errors), 4) if errors else None,
+        "corner_error_rel_max": max(errors) if errors else None,
+        "latency_sec_mean": round(statistics.mean(r["latency_sec"] for r in rows), 4),
+        "quantized_latency_sec_mean": round(statistics.mean(r["quantized_latency_sec"] for r in rows), 4),
+        "tolerance": args.tolerance,
+    }
+    summary["speedup"] = round(summary["latency_sec_mean"] / summary["quantized_latency_sec_mean"], 2)
+    summary["corners_hold"] = all(e <= args.tolerance for e in errors)
+
+    print(f"IoU mean {summary['iou_mean']:.3f}, min {summary['iou_min']:.3f}")
+    if errors:
+        print(f"Corner error mean {summary['corner_error_rel_mean'] * 100:.2f}%, max {summary['corner_error_rel_max'] * 100:.2f}% of the diagonal")
+    print(f"Latency {summary['latency_sec_mean']:.3f} s -> {summary['quantized_latency_sec_mean']:.3f} s, speedup x{summary['speedup']}")
+    print("Corners hold up" if summary["corners_hold"] else f"Corner error exceeds {args.tolerance * 100:.1f}% of the diagonal")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"summary": summary, "photos": rows}, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+# Load test of the rembg service: replay the example photos against /remove
+# at given concurrency and request rate, and save the results to JSON.
+#
+# Run the service first, then for example:
+#   python examples/rembg_benchmark/load_test.py --url http://127.0.0.1:80 \
+#       --models birefnet-general,birefnet-general-lite --concurrency 1,4,8 --requests 50 \
+#       --output results.json
+#
+# Every request gets a few random bytes after the end of the JPEG, so the
+# result cache of the service does not answer repeated photos (--keep-cache to disable).
+
+import aiohttp # For HTTP requests to rembg service
+import argparse # For command line options
+import asyncio # For concurrent requests
+import glob # For finding the example photos
+import itertools # For sweeping the options
+import json # For saving the results
+import os # For paths
+import re # For photo file names
+import statistics # For latency percentiles
+import time # For measuring time
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DEFAULT_IMAGES = [os.path.join(EXAMPLES_DIR, "find_cover"), os.path.join(EXAMPLES_DIR, "find_cover2")]
+PHOTO_NAME = re.compile(r"^(cover)?\d+\.jpg$") # Source photos in the examples directories
+RSS_INTERVAL_sec = 0.5 # How often to sample the memory of the service
+
+# =========================================================
+# Load all photos from the files and directories
+def load_images(paths: list[str]) -> list[bytes]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            # Only source photos (1.jpg, cover1.jpg), not the masks and results saved next to them
+            files += sorted(f for f in glob.glob(os.path.join(path, "*.jpg")) if PHOTO_NAME.match(os.path.basename(f)))
+        else:
+            files.append(path)
+    images = []
+    for file in files:
+        with open(file, "rb") as f:
+            images.append(f.read())
+    return images
+
+# =========================================================
+# Total resident memory of the service and its workers from /queue
+async def service_rss(session: aiohttp.ClientSession, url: str) -> int | None:
+    try:
+        async with session.get(f"{url}/queue") as resp:
+            data = await resp.json()
+    except Exception:
+        return None
+    values = [data.get("memory", {}).get("rss_bytes")] + [w.get("rss_bytes") for w in data.get("workers", [])]
+    values = [v for v in values if v is not None]
+    return sum(values) if values else None
+
+# =========================================================
+# Sample the memory of the service until cancelled, keep the peak in `peak`
+async def watch_rss(session: aiohttp.ClientSession, url: str, peak: dict) -> None:
+    while True:
+        rss = await service_rss(session, url)
+        if rss is not None:
+            peak["rss"] = max(peak.get("rss", 0), rss)
+        await asyncio.sleep(RSS_INTERVAL_sec)
+
+# =========================================================
+# Percentile of sorted values
+def percentile(values: list[float], p: float) -> float | None:
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def round4(value: float | None) -> float | None:
+    return round(value, 4) if value is not None else None
+
+# =========================================================
+# Wait until the service has loaded the models
+async def wait_ready(session: aiohttp.ClientSession, url: str) -> None:
+    while True:
+        try:
+            async with session.get(f"{url}/ready") as resp:
+                if resp.status == 200:
+                    return
+        except aiohttp.ClientConnectionError:
+            pass
+        await asyncio.sleep(1)
+
+# =========================================================
+# One run: `requests` requests to one model with given concurrency and rate
+async def run(session: aiohttp.ClientSession, args, images: list[bytes], model: str, concurrency: int, rate: float) -> dict:
+    latencies = []
+    statuses = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    params = dict(p.split("=", 1) for p in args.params.split("&") if p)
+    params["model"] = model
+
+    async def one(index: int, scheduled: float | None) -> None:
+        async with semaphore:
+            body = images[index % len(images)]
+            if not args.keep_cache:
+                body += os.urandom(16)
+            # In open loop the latency counts from the scheduled send time, with the wait for a free slot
+            started = scheduled if scheduled is not None else time.perf_counter()
+            try:
+                async with session.post(f"{args.url}{args.endpoint}", params=params, data=body) as resp:
+                    await resp.read()
+                    status = str(resp.status)
+            except Exception as e:
+                status = type(e).__name__
+            if status == "200":
+                latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    peak = {}
+    watcher = asyncio.create_task(watch_rss(session, args.url, peak))
+    started = time.perf_counter()
+    tasks = []
+    for i in range(args.requests):
+        scheduled = None
+        if rate > 0:
+            # Open loop: send at the given rate, no matter how fast the answers are
+            scheduled = started + i / rate
+            await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+        tasks.append(asyncio.create_task(one(i, scheduled)))
+    await asyncio.gather(*tasks)
+    duration = time.perf_counter() - started
+    watcher.cancel()
+
+    latencies.sort()
+    errors = args.requests - len(latencies)
+    return {
+        "model": model,
+        "concurrency": concurrency,
+        "rate": rate,
+        "requests": args.requests,
+        "ok": len(latencies),
+        "errors": errors,
+        "error_rate": round(errors / args.requests, 4),
+        "statuses": statuses,
+        "duration_sec": round(duration, 3),
+        "throughput_rps": round(len(latencies) / duration, 3),
+        "latency_sec": {
+            "mean": round(statistics.mean(latencies), 4) if latencies else None,
+            "p50": round4(percentile(latencies, 50)),
+            "p95": round4(percentile(latencies, 95)),
+            "p99": round4(percentile(latencies, 99)),
+            "max": round4(latencies[-1] if latencies else None),
+        },
+        "peak_rss_bytes": peak.get("rss"),
+    }
+
+# =========================================================
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test of the rembg service")
+    parser.add_argument("images", nargs="*", default=DEFAULT_IMAGES, help="photos or directories with .jpg photos (default: examples/find_cover and find_cover2)")
+    parser.add_argument("--url", default="http://127.0.0.1:80", help="rembg service URL")
+    parser.add_argument("--endpoint", default="/remove", help="/remove or /cover")
+    parser.add_argument("--params", default="only_mask=true", help="query parameters of every request")
+    parser.add_argument("--models", default="birefnet-general", help="comma separated models to test")
+    parser.add_argument("--concurrency", default="1,4", help="comma separated numbers of requests in flight (with --rate, the requests over it wait and the wait counts in latency)")
+    parser.add_argument("--rate", default="0", help="comma separated requests per second (0 - as fast as answered)")
+    parser.add_argument("--requests", type=int, default=50, help="requests in every run")
+    parser.add_argument("--keep-cache", action="store_true", help="send the photos unchanged, so the cache may answer")
+    parser.add_argument("--output", help="JSON file for the results")
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    if not images:
+        parser.error("no images found")
+    models = args.models.split(",")
+    concurrencies = [int(c) for c in args.concurrency.split(",")]
+    rates = [float(r) for r in args.rate.split(",")]
+
+    results = []
+    print(f"{len(images)} images, {args.requests} requests per run to {args.url}{args.endpoint}?{args.params}")
+    print(f"{'model':<24} {'conc':>4} {'rate':>5} | {'rps':>6} {'p50 s':>6} {'p95 s':>6} {'p99 s':>6} {'err %':>5} {'RSS MB':>7}")
+    timeout = aiohttp.ClientTimeout(total=None)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        await wait_ready(session, args.url)
+        for model, concurrency, rate in itertools.product(models, concurrencies, rates):
+            result = await run(session, args, images, model, concurrency, rate)
+            results.append(result)
+            latency = result["latency_sec"]
+            rss = f"{result['peak_rss_bytes'] / 2**20:.0f}" if result["peak_rss_bytes"] else "-"
+            print(f"{model:<24} {concurrency:>4} {rate:>5g} | {result['throughput_rps']:>6.2f} "
+                  f"{latency['p50'] or 0:>6.3f} {latency['p95'] or 0:>6.3f} {latency['p99'] or 0:>6.3f} "
+                  f"{result['error_rate'] * 100:>5.1f} {rss:>7}")
+
+    if args.output:
+        report = {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "url": args.url,
+            "endpoint": args.endpoint,
+            "params": args.params,
+            "images": len(images),
+            "runs": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
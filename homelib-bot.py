@@ -4,20 +4,25 @@ import logging # For logging
 import modules.database as db # For database functions and definitions
 import modules.engine as eng # For crossplatform bot engine functions and definitions
 import modules.actions as act # For bot commands and actions
+import modules.geometry_pool as gp # For image processing off the event loop
+import modules.s3storage as s3 # For uploading photos to S3 storage
+import modules.stages as stg # For timing the stages of adding a book
+import modules.blobstore as blobs # For keeping brief photos between messages
+import modules.vlm as vlm # For asking the Vision LLM
 
 # Prepare logging
 logging.basicConfig(level=logging.INFO)
 
-# Initialize bot
-eng.init_bot(os.getenv("MESSENGER"), db.POSTGRES_CONFIG, os.getenv("ONLY_USER"), os.getenv("EXCLUDE_USER"))
-
-# Initialize routers
-eng.first_router = eng.init_router()
-eng.base_router = eng.init_router()
-eng.last_router = eng.init_router()
-
 # Start the bot
 async def main():
+    # Initialize bot here, not at import: worker processes of the geometry pool import this module too
+    eng.init_bot(os.getenv("MESSENGER"), db.POSTGRES_CONFIG, os.getenv("ONLY_USER"), os.getenv("EXCLUDE_USER"))
+
+    # Initialize routers
+    eng.first_router = eng.init_router()
+    eng.base_router = eng.init_router()
+    eng.last_router = eng.init_router()
+
     try:
         # Messenger table creation (if not exists)
         await eng.storage.init()
@@ -44,12 +49,35 @@ async def main():
         # Books table creation (if not exists)
         await db.init()
 
+        # Start the pool for image processing
+        gp.init()
+
+        # Open the S3 client
+        await s3.init()
+
+        # Create the Vision LLM client
+        vlm.init()
+
+        # Open the store of brief photos
+        blobs.init()
+
+        # Export the histograms of the stages of adding a book
+        stg.init()
+
         # Start bot polling
         await eng.dp.start_polling(eng.bot)
     finally:
         # Close database connection pool
         if db.pool:
             await db.pool.close()
+        # Stop the pool for image processing
+        gp.close()
+        # Close the shared HTTP client
+        await eng.close_http_session()
+        # Close the S3 client
+        await s3.close()
+        # Close the Vision LLM client
+        await vlm.close()
 
 # Run the bot in global thread
 if __name__ == '__main__':
@@ -1,18 +1,63 @@
+import argparse
 import asyncio
+import contextlib
+import hashlib
+import itertools
+import io
+import json
 import logging
+import math
+import multiprocessing
 import os
-from typing import Optional, Any
+import re
+import statistics
+import struct
+import sys
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, replace
+from typing import Optional
 
+import numpy as np
+import onnxruntime as ort
 from aiohttp import web
-from rembg import remove, new_session
+from PIL import Image
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from rembg.bg import fix_image_orientation, naive_cutout
+from rembg.sessions import BiRefNetSessionGeneral, sessions_class
+
+from modules.cover_geometry import find_corners, cut_cover_jpeg, scale_corners
+from modules.lru_store import LruStore
 
 # ========================================================
 # Configuration
 # ========================================================
 HOST = os.getenv("REMBG_HOST", "0.0.0.0")
 PORT = int(os.getenv("REMBG_PORT", "80"))
-MODEL = os.getenv("REMBG_MODEL", "birefnet-general")
+MODEL = os.getenv("REMBG_MODEL", "birefnet-general")  # Default model
+# Models preloaded in every worker and available via ?model=, the default one is always included
+MODELS = list(dict.fromkeys([MODEL] + [m.strip() for m in os.getenv("REMBG_MODELS", "").split(",") if m.strip()]))
 MAX_CONTENT_LENGTH = int(os.getenv("REMBG_MAX_SIZE", str(50 * 1024 * 1024)))  # 50 MB
+BATCH_MS = int(os.getenv("REMBG_BATCH_MS", "50"))  # Window to collect requests into one batch
+BATCH_MAX = int(os.getenv("REMBG_BATCH_MAX", "4"))  # Maximum images in one batch
+WORKERS = max(1, int(os.getenv("REMBG_WORKERS", "1")))  # Worker processes, each with its own model session
+LATENCY_WINDOW = int(os.getenv("REMBG_LATENCY_WINDOW", "50"))  # Batches in the rolling average of inference time
+MAX_SIDE = int(os.getenv("REMBG_MAX_SIDE", "0"))  # Downscale inputs to this longest side before inference (0 - disabled)
+CACHE_MB = int(os.getenv("REMBG_CACHE_MB", "64"))  # In-memory result cache size (0 - disabled)
+CACHE_DIR = os.getenv("REMBG_CACHE_DIR", "")  # Directory of the on-disk result cache (empty - disabled)
+CACHE_DISK_MB = int(os.getenv("REMBG_CACHE_DISK_MB", "1024"))  # On-disk result cache size
+MAX_QUEUE = int(os.getenv("REMBG_MAX_QUEUE", "32"))  # Requests waiting or being processed, more get 429 (0 - unlimited)
+TIMEOUT = float(os.getenv("REMBG_TIMEOUT", "0"))  # Default request timeout in seconds, when the client sets none (0 - none)
+# ONNX Runtime session options of every model in every worker, see SessionSettings
+INTRA_THREADS = int(os.getenv("REMBG_INTRA_THREADS", "0"))  # Threads inside one operator (0 - ONNX Runtime default, all cores)
+INTER_THREADS = int(os.getenv("REMBG_INTER_THREADS", "0"))  # Threads between operators in parallel mode (0 - default)
+GRAPH_OPT = os.getenv("REMBG_GRAPH_OPT", "all")  # Graph optimization level: disable, basic, extended, all
+EXECUTION_MODE = os.getenv("REMBG_EXECUTION_MODE", "sequential")  # Operators execution: sequential, parallel
+MEM_ARENA = os.getenv("REMBG_MEM_ARENA", "true").lower() in ("true", "1", "yes")  # CPU memory arena
+MEM_PATTERN = os.getenv("REMBG_MEM_PATTERN", "true").lower() in ("true", "1", "yes")  # Memory pattern planning
 
 # ========================================================
 # Logging
@@ -21,110 +66,1358 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(me
 log = logging.getLogger("rembg-service")
 
 # ========================================================
-# Session & queue management
+# Metrics
+# ========================================================
+# Stages inside the workers are timed there and observed here from RemoveResult
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+REQUESTS = Counter("rembg_requests_total", "HTTP requests by endpoint and status", ["endpoint", "status"])
+REQUEST_SECONDS = Histogram("rembg_request_seconds", "Whole HTTP request handling time", ["endpoint"], buckets=SECONDS_BUCKETS)
+ERRORS = Counter("rembg_errors_total", "Requests failed with a server error", ["endpoint"])
+TOO_LARGE = Counter("rembg_rejected_too_large_total", "Requests rejected with 413 Payload too large", ["endpoint"])
+READ_BODY_SECONDS = Histogram("rembg_read_body_seconds", "Time to read the request body", ["endpoint"], buckets=SECONDS_BUCKETS)
+QUEUE_WAIT_SECONDS = Histogram("rembg_queue_wait_seconds", "Time from enqueueing to sending to a worker", ["model"], buckets=SECONDS_BUCKETS)
+DECODE_SECONDS = Histogram("rembg_decode_seconds", "Image decode and downscale time per image", buckets=SECONDS_BUCKETS)
+INFERENCE_SECONDS = Histogram("rembg_inference_seconds", "Model inference time per batch", ["model"], buckets=SECONDS_BUCKETS)
+ENCODE_SECONDS = Histogram("rembg_encode_seconds", "Mask postprocessing and response encoding time per image", ["format"], buckets=SECONDS_BUCKETS)
+BATCH_SIZE = Histogram("rembg_batch_size", "Images in one batch", buckets=(1, 2, 3, 4, 6, 8, 12, 16))
+INPUT_BYTES = Histogram("rembg_input_bytes", "Size of the request body", ["endpoint"],
+                        buckets=(16e3, 64e3, 256e3, 512e3, 1e6, 2e6, 4e6, 8e6, 16e6, 32e6, 64e6))
+IMAGE_SIDE_PIXELS = Histogram("rembg_image_side_pixels", "Width and height of the source images", ["side"],
+                              buckets=(256, 512, 768, 1024, 1280, 1600, 2048, 3000, 4096, 6000, 8192))
+QUEUE_SIZE = Gauge("rembg_queue_size", "Requests waiting or being processed")
+BUSY_WORKERS = Gauge("rembg_busy_workers", "Workers running a batch right now")
+
+# ========================================================
+# Batched inference
 # ========================================================
-_session_hq = None
 
-def get_session():
-    """Get or create rembg session (lazy initialization)"""
-    global _session_hq
-    if _session_hq is None:
-        log.info("Initializing rembg session with model '%s' ...", MODEL)
-        _session_hq = new_session(MODEL)
-        log.info("Session ready.")
-    return _session_hq
+def supports_batch(session) -> bool:
+    """Check if the session can run several images in one ONNX call.
+
+    Only BiRefNet models are batched: their pre- and post-processing is known,
+    and the exported graph must have a dynamic batch dimension.
+    """
+    if not isinstance(session, BiRefNetSessionGeneral):
+        return False
+    batch_dim = session.inner_session.get_inputs()[0].shape[0]
+    return not isinstance(batch_dim, int)
+
+def predict_batch(session, images: list[Image.Image]) -> list[Image.Image]:
+    """Predict masks for several images, in one ONNX call if the model allows it"""
+    if len(images) < 2 or not supports_batch(session):
+        return [session.predict(img)[0] for img in images]
 
-# Semaphore to limit concurrent rembg operations to 1
-_rembg_semaphore = asyncio.Semaphore(1)
+    # Same normalization and sigmoid as BiRefNetSessionGeneral.predict, but for the whole batch
+    input_name = session.inner_session.get_inputs()[0].name
+    inputs = [
+        session.normalize(img, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (1024, 1024))[input_name]
+        for img in images
+    ]
+    ort_outs = session.inner_session.run(None, {input_name: np.concatenate(inputs, axis=0)})
+    preds = session.sigmoid(ort_outs[0][:, 0, :, :])
 
-# Counter for tracking queue position
-_queue_counter = 0
-_queue_lock = asyncio.Lock()
+    masks = []
+    for pred, img in zip(preds, images):
+        ma = np.max(pred)
+        mi = np.min(pred)
+        pred = (pred - mi) / (ma - mi)
+        mask = Image.fromarray((pred * 255).astype("uint8"), mode="L")
+        masks.append(mask.resize(img.size, Image.Resampling.LANCZOS))
+    return masks
 
-async def get_queue_size() -> int:
-    async with _queue_lock:
-        return _queue_counter
+@dataclass
+class RemoveOptions:
+    """Per-request options of /remove"""
+    only_mask: bool = False
+    max_side: int = 0  # Downscale the input to this longest side before inference (0 - keep original size)
+    upscale: bool = True  # Upsample the mask back to the original size (ignored for full cutouts)
+    format: str = "png"  # Response format: png, or raw / rle for only_mask, or corners / jpeg for /cover
+    model: str = MODEL  # One of the preloaded MODELS
 
-async def async_remove(input_data: bytes, executor: Optional[Any] = None, **kwargs) -> bytes:
-    """Asynchronous wrapper for rembg.remove with queue management"""
-    async with _queue_lock:
-        global _queue_counter
-        _queue_counter += 1
+MASK_FORMATS = ("png", "raw", "rle")
+COVER_FORMATS = ("corners", "jpeg")
+MASK_HEADER = struct.Struct("<II")  # width, height of raw and rle masks
+
+@dataclass
+class RemoveResult:
+    """PNG produced for one request and the size of the source image"""
+    body: bytes
+    width: int
+    height: int
+    original_width: int
+    original_height: int
+    decode_seconds: float = 0.0  # Stage timings in the worker, for metrics
+    inference_seconds: float = 0.0  # of the whole batch
+    encode_seconds: float = 0.0
+    queue_seconds: float = 0.0  # Wait in the scheduler queue
+    cached: bool = False  # Taken from the result cache, no stage was run for this request
+
+def open_image(data: bytes, options: RemoveOptions) -> tuple[Image.Image, Optional[Image.Image]]:
+    """Decode the request image and prepare the model input.
+
+    Returns:
+        (image for the model, full-size image or None if it is not needed).
+        When only the mask is requested, a large JPEG is decoded directly at
+        a reduced scale, so the full-size pixels are never materialized.
+    """
+    img = Image.open(io.BytesIO(data))
+    if options.max_side <= 0 or max(img.size) <= options.max_side:
+        img = fix_image_orientation(img)
+        return img, img
+    full = None
+    if options.only_mask:
+        img.draft("RGB", (options.max_side, options.max_side))
+        img = fix_image_orientation(img)
+    else:
+        img = full = fix_image_orientation(img)
+    scale = options.max_side / max(img.size)
+    if scale < 1:
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        img = img.convert("RGB").resize(size, Image.Resampling.BILINEAR)
+    return img, full
+
+def encode_mask(mask: Image.Image, fmt: str) -> bytes:
+    """Encode a grayscale mask for the wire.
+
+    raw: header (uint32 width, uint32 height) + width*height uint8 pixels, row by row.
+    rle: header (uint32 width, uint32 height) + uint32 lengths of alternating runs
+         of background and foreground pixels of the mask binarized at 127.
+         The first run is background and may have zero length.
+    """
+    pixels = np.asarray(mask.convert("L"))
+    header = MASK_HEADER.pack(mask.width, mask.height)
+    if fmt == "raw":
+        return header + pixels.tobytes()
+    flat = (pixels > 127).ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate(([0], changes, [flat.size]))
+    runs = np.diff(bounds)
+    if flat.size and flat[0]:
+        runs = np.concatenate(([0], runs))
+    return header + runs.astype("<u4").tobytes()
+
+def cover_result(data: bytes, mask: Image.Image, size: tuple[int, int], fmt: str) -> bytes:
+    """Find the cover on the mask and return its corners as JSON or the cut cover as JPEG.
+
+    The mask may be smaller than the source image, then the corners found on
+    it are scaled to the source image coordinates.
+    """
+    binary_mask = np.where(np.asarray(mask.convert("L")) > 127, 255, 0).astype(np.uint8)
+    rect = scale_corners(find_corners(binary_mask), mask.size, size)
+    if fmt == "corners":
+        return json.dumps({"corners": rect.round(1).tolist(), "width": size[0], "height": size[1]}).encode()
+    return cut_cover_jpeg(data, rect)
+
+def original_size(data: bytes) -> tuple[int, int]:
+    """Size of the request image after EXIF orientation, without decoding pixels"""
+    img = Image.open(io.BytesIO(data))
+    orientation = img.getexif().get(0x0112, 1)
+    return (img.height, img.width) if orientation in (5, 6, 7, 8) else img.size
+
+def remove_batch(session, items: list[tuple[bytes, RemoveOptions]]) -> list[RemoveResult | Exception]:
+    """Batched equivalent of rembg.remove for raw image bytes.
+
+    Args:
+        session: rembg session to run the model with.
+        items: list of (image bytes, options) pairs.
+
+    Returns:
+        Result for every item, or the exception raised while processing it,
+        so that one broken image does not fail the whole batch.
+    """
+    results: list[RemoveResult | Exception | None] = [None] * len(items)
+    indexes = []
+    images = []
+    decode_seconds = []
+    for i, (data, options) in enumerate(items):
+        started = time.perf_counter()
+        try:
+            images.append(open_image(data, options))
+            indexes.append(i)
+            decode_seconds.append(time.perf_counter() - started)
+        except Exception as e:
+            results[i] = e
+
+    started = time.perf_counter()
     try:
-        async with _rembg_semaphore:
-            loop = asyncio.get_running_loop()
-            result = await loop.run_in_executor(
-                executor,
-                lambda: remove(input_data, **kwargs)
+        masks = predict_batch(session, [img for img, _full in images])
+    except Exception as e:
+        for i in indexes:
+            results[i] = e
+        return results
+    inference_seconds = time.perf_counter() - started
+
+    for i, (img, full), mask, decoded in zip(indexes, images, masks, decode_seconds):
+        data, options = items[i]
+        started = time.perf_counter()
+        try:
+            size = full.size if full is not None else original_size(data)
+            if options.only_mask:
+                cutout = mask
+                if options.upscale and mask.size != size:
+                    cutout = mask.resize(size, Image.Resampling.BILINEAR)
+            else:
+                if mask.size != full.size:
+                    mask = mask.resize(full.size, Image.Resampling.BILINEAR)
+                cutout = naive_cutout(full, mask)
+            if options.format in COVER_FORMATS:
+                body = cover_result(data, cutout, size, options.format)
+            elif options.format == "png":
+                bio = io.BytesIO()
+                cutout.save(bio, "PNG")
+                body = bio.getvalue()
+            else:
+                body = encode_mask(cutout, options.format)
+            results[i] = RemoveResult(
+                body=body,
+                width=cutout.width,
+                height=cutout.height,
+                original_width=size[0],
+                original_height=size[1],
+                decode_seconds=decoded,
+                inference_seconds=inference_seconds,
+                encode_seconds=time.perf_counter() - started,
             )
+        except Exception as e:
+            results[i] = e
+    return results
+
+# ========================================================
+# ONNX Runtime sessions
+# ========================================================
+
+GRAPH_OPT_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+EXECUTION_MODES = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+
+@dataclass(frozen=True)
+class SessionSettings:
+    """ONNX Runtime options of a model session.
+
+    With several workers on one host, intra_threads should be about
+    the number of cores divided by the number of workers, otherwise the
+    workers fight for the cores and latency grows.
+    """
+    intra_threads: int = 0  # 0 - ONNX Runtime default
+    inter_threads: int = 0  # 0 - ONNX Runtime default, used only in parallel mode
+    graph_opt: str = "all"
+    execution_mode: str = "sequential"
+    mem_arena: bool = True
+    mem_pattern: bool = True
+
+    def __post_init__(self):
+        if self.graph_opt not in GRAPH_OPT_LEVELS:
+            raise ValueError(f"Unknown graph optimization level '{self.graph_opt}', use one of: {', '.join(GRAPH_OPT_LEVELS)}")
+        if self.execution_mode not in EXECUTION_MODES:
+            raise ValueError(f"Unknown execution mode '{self.execution_mode}', use one of: {', '.join(EXECUTION_MODES)}")
+
+    def session_options(self) -> ort.SessionOptions:
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = self.intra_threads
+        options.inter_op_num_threads = self.inter_threads
+        options.graph_optimization_level = GRAPH_OPT_LEVELS[self.graph_opt]
+        options.execution_mode = EXECUTION_MODES[self.execution_mode]
+        options.enable_cpu_mem_arena = self.mem_arena
+        options.enable_mem_pattern = self.mem_pattern
+        return options
+
+    def describe(self) -> str:
+        return (f"intra_threads={self.intra_threads or 'default'}, inter_threads={self.inter_threads or 'default'}, "
+                f"graph_opt={self.graph_opt}, execution_mode={self.execution_mode}, "
+                f"mem_arena={self.mem_arena}, mem_pattern={self.mem_pattern}")
+
+SESSION_SETTINGS = SessionSettings(
+    intra_threads=INTRA_THREADS,
+    inter_threads=INTER_THREADS,
+    graph_opt=GRAPH_OPT,
+    execution_mode=EXECUTION_MODE,
+    mem_arena=MEM_ARENA,
+    mem_pattern=MEM_PATTERN,
+)
+
+QUANTIZED_SUFFIX = "-int8"  # Model name suffix of the int8-quantized variant, e.g. birefnet-general-int8
+# Only matrix multiplications are quantized: ConvInteger is slower than float Conv on most CPUs
+QUANTIZED_OPS = ["MatMul", "Gemm"]
+
+def quantize_model(path: str) -> str:
+    """Return the path of the int8-quantized copy of the ONNX model, make it on first use"""
+    root, ext = os.path.splitext(path)
+    quantized = f"{root}{QUANTIZED_SUFFIX}{ext}"
+    if os.path.exists(quantized):
+        return quantized
+    from onnxruntime.quantization import QuantType, quantize_dynamic  # Needs onnx, only for quantized models
+    log.info("Quantizing %s to int8 ...", path)
+    started = time.monotonic()
+    temporary = f"{quantized}.{os.getpid()}.tmp"  # Workers may quantize at the same time
+    quantize_dynamic(path, temporary, op_types_to_quantize=QUANTIZED_OPS, weight_type=QuantType.QInt8)
+    os.replace(temporary, quantized)
+    log.info("Quantized model %s saved in %.1f s", quantized, time.monotonic() - started)
+    return quantized
+
+def quantized_class(base_class):
+    """Session class of the int8 variant of the model: same pre- and post-processing, quantized weights"""
+    class QuantizedSession(base_class):
+        @classmethod
+        def download_models(cls, *args, **kwargs):
+            return quantize_model(str(base_class.download_models(*args, **kwargs)))
+
+        @classmethod
+        def name(cls, *args, **kwargs):
+            return base_class.name(*args, **kwargs) + QUANTIZED_SUFFIX
+    return QuantizedSession
+
+def create_session(model: str, settings: SessionSettings):
+    """rembg new_session with our ONNX Runtime options.
+
+    A model name with the -int8 suffix loads the int8-quantized variant of
+    the model, quantized with dynamic quantization on first use and saved
+    next to the original model file.
+    """
+    quantized = model.endswith(QUANTIZED_SUFFIX)
+    base = model[:-len(QUANTIZED_SUFFIX)] if quantized else model
+    for session_class in sessions_class:
+        if session_class.name() == base:
+            if quantized:
+                session_class = quantized_class(session_class)
+            return session_class(model, settings.session_options())
+    raise ValueError(f"No session class found for model '{model}'")
+
+# ========================================================
+# Worker processes
+# ========================================================
+
+# rembg sessions of the current worker process by model name
+_worker_sessions: dict = {}
+
+def warmup_session(session) -> None:
+    """Run a dummy inference, so ONNX Runtime allocates memory and prepares
+    its kernels before the first real request"""
+    predict_batch(session, [Image.new("RGB", (64, 64))])
+
+def init_worker(models: list[str], settings: SessionSettings) -> None:
+    """Process pool initializer: load and warm up the models once per worker process"""
+    for model in models:
+        log.info("Worker %d: initializing rembg session with model '%s' ...", os.getpid(), model)
+        started = time.monotonic()
+        session = create_session(model, settings)
+        warmup_session(session)
+        _worker_sessions[model] = session
+        log.info("Worker %d: model '%s' ready in %.1f s.", os.getpid(), model, time.monotonic() - started)
+
+def process_memory(pid: Optional[int]) -> dict:
+    """Resident memory of the process and its peak, in bytes (Linux only, None elsewhere)"""
+    memory = {"rss_bytes": None, "peak_rss_bytes": None}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    memory["rss_bytes"] = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    memory["peak_rss_bytes"] = int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return memory
+
+def worker_info() -> tuple[int, dict[str, bool]]:
+    """Trivial task to start a worker process and wait for its initializer.
+
+    Returns the process ID and, for every model, whether it runs several
+    images in one ONNX call (see supports_batch).
+    """
+    return os.getpid(), {model: supports_batch(session) for model, session in _worker_sessions.items()}
+
+def worker_remove_batch(model: str, items: list[tuple[bytes, RemoveOptions]]) -> list[RemoveResult | Exception]:
+    """Run remove_batch on the session of the model in the current worker process"""
+    return remove_batch(_worker_sessions[model], items)
+
+class Worker:
+    """One worker process with its own preloaded rembg sessions"""
+    def __init__(self, index: int, models: list[str], settings: SessionSettings):
+        self.index = index
+        self.models = models
+        self.settings = settings
+        self.pid: Optional[int] = None
+        self.batch_models: dict[str, bool] = {}  # Models able to run a batch in one call, known after start
+        self.reserved = False  # Worker is taken by the scheduler for the next batch
+        self.busy = 0  # Images being processed right now
+        self.processed = 0  # Images processed since start
+        self.healthy = True  # False from the death of the process until it is restarted
+        self._restart_task: Optional[asyncio.Task] = None
+        self.executor = self._create_executor()
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(self.models, self.settings),
+        )
+
+    async def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        self.pid, self.batch_models = await loop.run_in_executor(self.executor, worker_info)
+
+    async def remove_batch(self, model: str, items: list[tuple[bytes, RemoveOptions]]) -> list[RemoveResult | Exception]:
+        loop = asyncio.get_running_loop()
+        self.busy += len(items)
+        try:
+            return await loop.run_in_executor(self.executor, worker_remove_batch, model, items)
+        except BrokenProcessPool:
+            # The process died (e.g. killed for memory), its executor never works again
+            self.restart()
+            raise
+        finally:
+            self.busy -= len(items)
+            self.processed += len(items)
+
+    def restart(self) -> None:
+        """Replace the broken executor with a new process and load the models in it in background"""
+        if self._restart_task and not self._restart_task.done():
+            return
+        log.error("Worker %d: process %s died, restarting it", self.index, self.pid)
+        self.healthy = False
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = self._create_executor()
+        self._restart_task = asyncio.create_task(self._restart())
+
+    async def _restart(self) -> None:
+        try:
+            await self.start()
+        except Exception:
+            # Stays unhealthy, the next batch sent to it fails and restarts it again
+            log.exception("Worker %d: restart failed", self.index)
+            return
+        self.healthy = True
+        log.info("Worker %d: restarted as process %d", self.index, self.pid)
+
+    def shutdown(self) -> None:
+        if self._restart_task:
+            self._restart_task.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {"worker": self.index, "pid": self.pid, "healthy": self.healthy, "busy": self.busy, "processed": self.processed,
+                **process_memory(self.pid)}
+
+class WorkerPool:
+    """Pool of worker processes, each of them runs one batch at a time"""
+    def __init__(self, size: int, models: list[str], settings: SessionSettings):
+        self.models = models
+        self.workers = [Worker(i, models, settings) for i in range(size)]
+        self._free = asyncio.Semaphore(size)
+
+    async def start(self) -> None:
+        """Spawn all workers and wait until every one of them has loaded and warmed up the models"""
+        await asyncio.gather(*(worker.start() for worker in self.workers))
+        for model in self.models:
+            if not self.can_batch(model):
+                log.info("Model '%s' has a fixed batch dimension, its requests are not batched", model)
+
+    def ready(self) -> bool:
+        """No worker is dead or restarting"""
+        return all(worker.healthy for worker in self.workers)
+
+    def idle(self) -> int:
+        """Number of workers not taken by the scheduler"""
+        return sum(1 for worker in self.workers if not worker.reserved)
+
+    def can_batch(self, model: str) -> bool:
+        """The model runs several images in one call in every worker"""
+        return all(worker.batch_models.get(model, False) for worker in self.workers)
+
+    def shutdown(self) -> None:
+        for worker in self.workers:
+            worker.shutdown()
+
+    async def acquire(self) -> Worker:
+        """Wait for an idle worker and reserve the least loaded one, restarting workers are the last resort"""
+        await self._free.acquire()
+        worker = min((w for w in self.workers if not w.reserved), key=lambda w: (not w.healthy, w.busy, w.processed))
+        worker.reserved = True
+        return worker
+
+    def release(self, worker: Worker) -> None:
+        worker.reserved = False
+        self._free.release()
+
+    def stats(self) -> list[dict]:
+        return [worker.stats() for worker in self.workers]
+
+# ========================================================
+# Micro-batching scheduler
+# ========================================================
+
+class QueueFullError(Exception):
+    """The queue is full, the request should be retried later"""
+    def __init__(self, retry_after: int):
+        super().__init__(f"Queue is full, retry after {retry_after} s")
+        self.retry_after = retry_after
+
+class DuplicateRequestError(Exception):
+    """A request with the same ID is already in the queue"""
+    def __init__(self, request_id: str):
+        super().__init__(f"Request {request_id} is already in the queue")
+        self.request_id = request_id
+
+@dataclass
+class BatchJob:
+    """One /remove request waiting for the scheduler"""
+    request_id: str
+    data: bytes
+    options: RemoveOptions
+    future: asyncio.Future
+    enqueued: float  # time.monotonic() of arrival
+    started: Optional[float] = None  # time.monotonic() of sending to a worker
+
+class BatchScheduler:
+    """Collect requests arriving within a short window and run them as one batch.
+
+    The first request of a batch waits at most `window_ms` for company,
+    a batch never exceeds `max_size` images, and every batch goes to an idle
+    worker of the pool. While other workers are idle, requests are not
+    collected but shared between them. While all workers are busy, requests
+    keep piling up and are taken as one bigger batch as soon as a worker is free.
+    A batch contains requests to one model only, requests to other models
+    met while collecting it are deferred to the next batches in their order.
+    Requests to a model that cannot run a batch in one call (see
+    supports_batch) are sent one by one, without waiting for company.
+
+    Every request has an ID, so its position in the queue and the estimated
+    time of completion can be asked while it waits. The estimation is based
+    on the rolling average of inference time per image.
+
+    No more than `max_queue` requests are accepted at once. Requests whose
+    callers stopped waiting (timeout or disconnect) are dropped from the queue
+    and are not sent to the workers.
+    """
+    def __init__(self, window_ms: int, max_size: int, pool: WorkerPool, latency_window: int = 50, max_queue: int = 0):
+        self.window = window_ms / 1000
+        self.max_size = max(1, max_size)
+        self.max_queue = max_queue
+        self.pool = pool
+        self._jobs: asyncio.Queue[BatchJob] = asyncio.Queue()
+        self._deferred: deque[BatchJob] = deque()  # Jobs taken from the queue for another model's batch
+        self._pending: OrderedDict[str, BatchJob] = OrderedDict()  # Unfinished jobs in order of arrival
+        self._aliases: dict[str, str] = {}  # Requests waiting for the result of an identical request -> its ID
+        self._image_times: deque[float] = deque(maxlen=max(1, latency_window))  # Seconds per image of recent batches
+        self._task: Optional[asyncio.Task] = None
+        self._batches: set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        for task in [self._task, *self._batches]:
+            if task:
+                task.cancel()
+        await asyncio.gather(*[t for t in [self._task, *self._batches] if t], return_exceptions=True)
+        self._task = None
+        self._batches.clear()
+
+    def size(self) -> int:
+        """Number of requests waiting or being processed"""
+        return len(self._pending)
+
+    def average_image_time(self) -> Optional[float]:
+        """Rolling average of inference seconds per image, None until the first batch"""
+        if not self._image_times:
+            return None
+        return sum(self._image_times) / len(self._image_times)
+
+    def estimate(self, ahead: int) -> Optional[float]:
+        """Estimated seconds to complete a request with `ahead` requests before it"""
+        average = self.average_image_time()
+        if average is None:
+            return None
+        return (ahead + 1) * average / len(self.pool.workers)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        average = self.average_image_time()
+        oldest = next(iter(self._pending.values()), None)
+        return {
+            "queue_size": self.size(),
+            "avg_inference_sec": round(average, 3) if average is not None else None,
+            "eta_sec": self._round(self.estimate(self.size())),
+            "oldest_wait_sec": round(now - oldest.enqueued, 3) if oldest else 0,
+        }
+
+    def is_known(self, request_id: str) -> bool:
+        """The request with this ID is in the queue, or waits for the result of another one"""
+        return request_id in self._pending or request_id in self._aliases
+
+    @contextlib.contextmanager
+    def alias(self, request_id: str, owner_id: str):
+        """While in the block, the state of the request is the state of the owner's request"""
+        if self.is_known(request_id):
+            raise DuplicateRequestError(request_id)
+        self._aliases[request_id] = owner_id
+        try:
+            yield
+        finally:
+            self._aliases.pop(request_id, None)
+
+    def status(self, request_id: str) -> Optional[dict]:
+        """Position and estimated completion time of the request, None if it is not in the queue"""
+        job_id = self._aliases.get(request_id, request_id)
+        job = self._pending.get(job_id)
+        if job is None:
+            return None
+        ahead = list(self._pending).index(job_id)
+        return {
+            "request_id": request_id,
+            "state": "running" if job.started is not None else "waiting",
+            "position": ahead,
+            "wait_sec": round(time.monotonic() - job.enqueued, 3),
+            "eta_sec": self._round(self.estimate(ahead)),
+        }
+
+    @staticmethod
+    def _round(value: Optional[float]) -> Optional[float]:
+        return round(value, 1) if value is not None else None
+
+    async def submit(self, data: bytes, options: RemoveOptions, request_id: Optional[str] = None) -> RemoveResult:
+        """Put the image into the queue and wait for its own result.
+
+        Raises:
+            QueueFullError: if there are already `max_queue` requests.
+            DuplicateRequestError: if a request with the same ID is in the queue.
+        """
+        if self.max_queue > 0 and self.size() >= self.max_queue:
+            # Retry when the requests already in the queue are done
+            raise QueueFullError(max(1, math.ceil(self.estimate(self.size()) or 1)))
+        request_id = request_id or uuid.uuid4().hex
+        if self.is_known(request_id):
+            raise DuplicateRequestError(request_id)
+        job = BatchJob(
+            request_id=request_id,
+            data=data,
+            options=options,
+            future=asyncio.get_running_loop().create_future(),
+            enqueued=time.monotonic(),
+        )
+        self._pending[request_id] = job
+        try:
+            await self._jobs.put(job)
+            return await job.future
+        finally:
+            self._pending.pop(request_id, None)
+
+    def fail_all(self, error: Exception) -> None:
+        """Fail all waiting requests, when the workers cannot serve them"""
+        for job in self._pending.values():
+            if not job.future.done():
+                job.future.set_exception(error)
+
+    async def _next(self) -> BatchJob:
+        while True:
+            if self._deferred:
+                job = self._deferred.popleft()
+            else:
+                job = await self._jobs.get()
+            if not job.future.done():  # Skip requests nobody waits for
+                return job
+
+    async def _collect(self, first: BatchJob) -> list[BatchJob]:
+        loop = asyncio.get_running_loop()
+        model = first.options.model
+        # Batch of a model that runs the images one by one only delays its first request
+        max_size = self.max_size if self.pool.can_batch(model) else 1
+        window = self.window
+        idle = self.pool.idle()  # Other workers free right now
+        if idle:
+            # Share the waiting requests with the idle workers instead of making one batch of them
+            queued = 1 + self._jobs.qsize() + len(self._deferred)
+            max_size = min(max_size, math.ceil(queued / (idle + 1)))
+            window = 0
+        batch = [first]
+        # Deferred jobs arrived earlier than the queued ones
+        others = deque()
+        while self._deferred:
+            job = self._deferred.popleft()
+            if job.future.done():
+                continue
+            if job.options.model == model and len(batch) < max_size:
+                batch.append(job)
+            else:
+                others.append(job)
+        self._deferred = others
+        deadline = loop.time() + window
+        while len(batch) < max_size:
+            if not self._jobs.empty():
+                job = self._jobs.get_nowait()
+            else:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    job = await asyncio.wait_for(self._jobs.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if job.future.done():
+                continue
+            if job.options.model == model:
+                batch.append(job)
+            else:
+                self._deferred.append(job)
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            first = await self._next()
+            worker = await self.pool.acquire()
+            batch = [job for job in await self._collect(first) if not job.future.done()]
+            if not batch:
+                self.pool.release(worker)
+                continue
+            task = asyncio.create_task(self._process(worker, batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _process(self, worker: Worker, batch: list[BatchJob]) -> None:
+        try:
+            if len(batch) > 1:
+                log.info("Running batch of %d images on worker %d with model '%s'", len(batch), worker.index, batch[0].options.model)
+            model = batch[0].options.model
+            items = [(job.data, job.options) for job in batch]
+            started = time.monotonic()
+            for job in batch:
+                job.started = started
+                QUEUE_WAIT_SECONDS.labels(model).observe(started - job.enqueued)
+            BATCH_SIZE.observe(len(batch))
+            try:
+                results = await worker.remove_batch(model, items)
+                self._image_times.append((time.monotonic() - started) / len(batch))
+            except Exception as e:
+                results = [e] * len(batch)
+            observe_results(batch, results)
+            for job, result in zip(batch, results):
+                if job.future.done():
+                    continue
+                if isinstance(result, Exception):
+                    job.future.set_exception(result)
+                else:
+                    job.future.set_result(replace(result, queue_seconds=started - job.enqueued))
+        finally:
+            self.pool.release(worker)
+
+def observe_results(batch: list[BatchJob], results: list[RemoveResult | Exception]) -> None:
+    """Put the stage timings measured in the worker into the metrics"""
+    done = [(job, result) for job, result in zip(batch, results) if isinstance(result, RemoveResult)]
+    if not done:
+        return
+    INFERENCE_SECONDS.labels(batch[0].options.model).observe(done[0][1].inference_seconds)
+    for job, result in done:
+        DECODE_SECONDS.observe(result.decode_seconds)
+        ENCODE_SECONDS.labels(job.options.format).observe(result.encode_seconds)
+
+# ========================================================
+# Result cache
+# ========================================================
+
+class ResultCache:
+    """Content-addressed cache of /remove results.
+
+    Results are kept in a LruStore (memory and optional disk tiers).
+    Concurrent requests with the same key share one computation.
+    """
+    _HEADER = struct.Struct("<4I")  # width, height, original_width, original_height
+
+    def __init__(self, memory_bytes: int, disk_dir: str = "", disk_bytes: int = 0):
+        self.store = LruStore(memory_bytes, disk_dir, disk_bytes)
+        self._inflight: dict[str, asyncio.Future] = {}
+        self.misses = 0
+        self.shared = 0
+
+    @staticmethod
+    def make_key(data: bytes, model: str, options: RemoveOptions) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        params = f"{model}|{options.only_mask}|{options.max_side}|{options.upscale}|{options.format}"
+        return hashlib.sha256(f"{digest}|{params}".encode()).hexdigest()
+
+    def stats(self) -> dict:
+        return {"misses": self.misses, "shared": self.shared, **self.store.stats()}
+
+    async def get_or_compute(self, key: str, compute, joined=contextlib.nullcontext) -> RemoveResult:
+        """Return the cached result or run `compute()` once for all concurrent callers.
+
+        Callers waiting for the computation of another one do it inside the `joined()` context.
+        """
+        result = await self.get(key)
+        if result is not None:
+            # Stage timings of the request that computed the result are not ours
+            return replace(result, decode_seconds=0.0, inference_seconds=0.0, encode_seconds=0.0, queue_seconds=0.0, cached=True)
+        while key in self._inflight:
+            self.shared += 1
+            shared = self._inflight[key]
+            try:
+                with joined():
+                    return await asyncio.shield(shared)
+            except asyncio.CancelledError:
+                # The caller computing the result went away, compute it ourselves
+                if not shared.cancelled() or asyncio.current_task().cancelling():
+                    raise
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())  # Do not warn when nobody shares it
+        self._inflight[key] = future
+        try:
+            result = await compute()
+            await self.put(key, result)
+            future.set_result(result)
             return result
-    finally:
-        async with _queue_lock:
-            _queue_counter -= 1
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def get(self, key: str) -> Optional[RemoveResult]:
+        data = await self.store.get(key)
+        if data is None:
+            return None
+        width, height, original_width, original_height = self._HEADER.unpack_from(data)
+        return RemoveResult(
+            body=data[self._HEADER.size:],
+            width=width,
+            height=height,
+            original_width=original_width,
+            original_height=original_height,
+        )
+
+    async def put(self, key: str, result: RemoveResult) -> None:
+        header = self._HEADER.pack(result.width, result.height, result.original_width, result.original_height)
+        await self.store.put(key, header + result.body)
+
+_pool: Optional[WorkerPool] = None
+_scheduler: Optional[BatchScheduler] = None
+_cache: Optional[ResultCache] = None
+_warmup_task: Optional[asyncio.Task] = None  # Loading of the models at startup
+
+def is_ready() -> bool:
+    """Models are loaded and warmed up in every worker, and no worker is restarting"""
+    return (_warmup_task is not None and _warmup_task.done() and not _warmup_task.cancelled()
+            and _warmup_task.exception() is None and _pool.ready())
+
+def warmup_error() -> Optional[BaseException]:
+    """Exception of the failed warmup, None while warming up or when ready"""
+    if _warmup_task is None or not _warmup_task.done() or _warmup_task.cancelled():
+        return None
+    return _warmup_task.exception()
+
+_cache_owners: dict[str, str] = {}  # Cache keys being computed -> ID of the request computing it
+
+async def async_remove(input_data: bytes, options: RemoveOptions, request_id: Optional[str] = None,
+                       timeout: Optional[float] = None) -> RemoveResult:
+    """Asynchronous wrapper for rembg.remove with micro-batching and result cache.
+
+    An identical request already being computed is shared, and /queue/{request_id}
+    reports the state of that request.
+
+    Raises:
+        QueueFullError: if the queue is full.
+        DuplicateRequestError: if a request with the same ID is in the queue.
+        asyncio.TimeoutError: if the result is not ready in `timeout` seconds,
+            then the request is dropped from the queue.
+    """
+    request_id = request_id or uuid.uuid4().hex
+    if _scheduler.is_known(request_id):
+        raise DuplicateRequestError(request_id)
+    if _cache is None:
+        work = _scheduler.submit(input_data, options, request_id)
+    else:
+        # Hashing a body of tens of megabytes would stall the event loop of the scheduler
+        key = await asyncio.to_thread(ResultCache.make_key, input_data, options.model, options)
+
+        async def compute() -> RemoveResult:
+            _cache_owners[key] = request_id
+            try:
+                return await _scheduler.submit(input_data, options, request_id)
+            finally:
+                if _cache_owners.get(key) == request_id:
+                    del _cache_owners[key]
+
+        def joined():
+            owner_id = _cache_owners.get(key)
+            return _scheduler.alias(request_id, owner_id) if owner_id else contextlib.nullcontext()
+
+        work = _cache.get_or_compute(key, compute, joined)
+    return await asyncio.wait_for(work, timeout)
+
+def get_deadline(request: web.Request) -> Optional[float]:
+    """time.monotonic() after which the client does not wait for the result any more.
+
+    X-Timeout header is the timeout in seconds, X-Deadline is the absolute
+    Unix time in seconds, REMBG_TIMEOUT is used if there are none of them.
+
+    Raises:
+        ValueError: if the header is not a number.
+    """
+    if "X-Timeout" in request.headers:
+        return time.monotonic() + float(request.headers["X-Timeout"])
+    if "X-Deadline" in request.headers:
+        return time.monotonic() + float(request.headers["X-Deadline"]) - time.time()
+    return time.monotonic() + TIMEOUT if TIMEOUT > 0 else None
+
+def time_left(deadline: Optional[float]) -> Optional[float]:
+    return max(0.0, deadline - time.monotonic()) if deadline is not None else None
+
+def overload_response(e: Exception, headers: dict) -> Optional[web.Response]:
+    """Response for a request rejected by the admission control, with a duplicate ID, or dropped after its deadline"""
+    if isinstance(e, QueueFullError):
+        log.warning("Request rejected: %s", e)
+        return web.Response(status=429, text=str(e), headers={**headers, "Retry-After": str(e.retry_after)})
+    if isinstance(e, DuplicateRequestError):
+        log.warning("Request rejected: %s", e)
+        return web.Response(status=409, text=str(e), headers=headers)
+    if isinstance(e, asyncio.TimeoutError):
+        log.warning("Request %s dropped after its deadline", headers.get("X-Request-ID"))
+        return web.Response(status=504, text="Deadline exceeded", headers=headers)
+    return None
+
+def get_request_id(request: web.Request) -> str:
+    """Request ID from the X-Request-ID header, or a new one"""
+    return request.headers.get("X-Request-ID", "").strip()[:64] or uuid.uuid4().hex
 
 # ========================================================
 # HTTP handlers
 # ========================================================
 
-async def handle_remove(request: web.Request) -> web.Response:
-    """POST /remove — remove background from image.
-    
-    Query params (optional):
-        only_mask=true  — return only the mask instead of the full result
-    
-    Request body: raw image bytes (Content-Type: application/octet-stream or image/*)
-    Response: processed image bytes (image/png)
-    """
-    # Read body
+def endpoint_of(request: web.Request) -> str:
+    """Route pattern of the request for metric labels, like /queue/{request_id}"""
+    route = request.match_info.route
+    return route.resource.canonical if route.resource is not None else "unknown"
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler) -> web.StreamResponse:
+    """Count requests by status and measure their handling time"""
+    endpoint = endpoint_of(request)
+    started = time.monotonic()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    except asyncio.CancelledError:
+        status = 499  # Client closed the connection
+        raise
+    finally:
+        REQUESTS.labels(endpoint, str(status)).inc()
+        REQUEST_SECONDS.labels(endpoint).observe(time.monotonic() - started)
+        if status == 413:
+            TOO_LARGE.labels(endpoint).inc()
+        elif status >= 500 and endpoint != "/ready":  # 503 of /ready is a normal answer while warming up
+            ERRORS.labels(endpoint).inc()
+
+async def read_body(request: web.Request) -> bytes:
+    """Read the request body and measure it"""
+    endpoint = endpoint_of(request)
+    started = time.monotonic()
     body = await request.read()
+    READ_BODY_SECONDS.labels(endpoint).observe(time.monotonic() - started)
+    INPUT_BYTES.labels(endpoint).observe(len(body))
+    return body
+
+def server_timing(result: RemoveResult) -> str:
+    """Server-Timing header with the stages of the request in milliseconds, and cache;desc=hit for a cached result"""
+    stages = (("queue", result.queue_seconds), ("decode", result.decode_seconds),
+              ("inference", result.inference_seconds), ("postprocess", result.encode_seconds))
+    metrics = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in stages]
+    if result.cached:
+        metrics.append("cache;desc=hit")
+    return ", ".join(metrics)
+
+def observe_image(result: RemoveResult) -> None:
+    IMAGE_SIDE_PIXELS.labels("width").observe(result.original_width)
+    IMAGE_SIDE_PIXELS.labels("height").observe(result.original_height)
+
+def check_body(body: bytes) -> Optional[web.Response]:
+    """Return an error response for an empty or too large request body"""
     if not body:
         return web.Response(status=400, text="Empty request body")
     if len(body) > MAX_CONTENT_LENGTH:
         return web.Response(status=413, text="Payload too large")
+    return None
 
-    only_mask = request.query.get("only_mask", "").lower() in ("true", "1", "yes")
-    
-    log.info("Remove request: %d bytes, only_mask=%s", len(body), only_mask)
+
+async def handle_remove(request: web.Request) -> web.Response:
+    """POST /remove — remove background from image.
+
+    Query params (optional):
+        only_mask=true  — return only the mask instead of the full result
+        max_side=N      — downscale the image to N pixels on the longest side before inference
+                          (default REMBG_MAX_SIDE, 0 - disabled)
+        upscale=false   — with only_mask, return the mask at the downscaled size
+        model=NAME      — one of the preloaded models (REMBG_MODELS), default REMBG_MODEL
+        format=png|raw|rle — with only_mask, return the mask as PNG (default), as raw 8-bit
+                          pixels or as run-length encoded binary mask (see encode_mask)
+
+    Request body: raw image bytes (Content-Type: application/octet-stream or image/*)
+    Request header X-Request-ID (optional) — ID to ask the state of the request in /queue/{request_id}
+    Request header X-Timeout (optional) — seconds to wait for the result, or X-Deadline — Unix time
+        of the deadline (default REMBG_TIMEOUT), after that the request is dropped with 504
+
+    Response: processed image bytes (image/png), or the mask (application/octet-stream)
+        X-Original-Width, X-Original-Height headers contain the size of the source image
+        X-Request-ID header contains the ID of the request
+        Server-Timing header contains the queue wait, decode, inference and postprocess
+            (mask and encoding) times in milliseconds, they are zero with cache;desc=hit
+            for a result taken from the cache
+        429 with Retry-After header if the queue is full (REMBG_MAX_QUEUE)
+        409 if a request with the same X-Request-ID is in the queue
+    """
+    request_id = get_request_id(request)
+    try:
+        deadline = get_deadline(request)
+    except ValueError:
+        return web.Response(status=400, text="Invalid X-Timeout or X-Deadline")
+    body = await read_body(request)
+    error = check_body(body)
+    if error:
+        return error
+    if warmup_error() is not None:
+        return web.Response(status=503, text="Models are not loaded")
 
     try:
-        result = await async_remove(
-            body,
-            session=get_session(),
-            only_mask=only_mask,
+        options = RemoveOptions(
+            only_mask=request.query.get("only_mask", "").lower() in ("true", "1", "yes"),
+            max_side=int(request.query.get("max_side", MAX_SIDE)),
+            upscale=request.query.get("upscale", "true").lower() in ("true", "1", "yes"),
+            format=request.query.get("format", "png").lower(),
+            model=request.query.get("model", MODEL),
         )
+    except ValueError:
+        return web.Response(status=400, text="Invalid max_side")
+    if options.format not in MASK_FORMATS or (options.format != "png" and not options.only_mask):
+        return web.Response(status=400, text="Invalid format")
+    if options.model not in MODELS:
+        return web.Response(status=400, text="Unknown model")
+
+    log.info("Remove request %s: %d bytes, model=%s, only_mask=%s, max_side=%d, format=%s", request_id, len(body), options.model, options.only_mask, options.max_side, options.format)
+
+    headers = {"X-Request-ID": request_id}
+    try:
+        result = await async_remove(body, options, request_id, time_left(deadline))
+        observe_image(result)
         return web.Response(
-            body=result,
-            content_type="image/png",
+            body=result.body,
+            content_type="image/png" if options.format == "png" else "application/octet-stream",
+            headers={
+                "X-Original-Width": str(result.original_width),
+                "X-Original-Height": str(result.original_height),
+                "Server-Timing": server_timing(result),
+                **headers,
+            },
         )
     except Exception as e:
+        response = overload_response(e, headers)
+        if response:
+            return response
         log.exception("Error processing image")
-        return web.Response(status=500, text=str(e))
+        return web.Response(status=500, text=str(e), headers=headers)
+
+
+async def handle_cover(request: web.Request) -> web.Response:
+    """POST /cover — find the book cover on the photo.
+
+    Runs the model and the whole geometry pipeline (mask cleanup, contour,
+    quadrilateral fitting and, for jpeg, the perspective transformation).
+
+    Query params (optional):
+        format=corners|jpeg — return the corners as JSON (default) or the cut cover as JPEG
+        max_side=N      — downscale the image to N pixels on the longest side before inference
+                          (default REMBG_MAX_SIDE, 0 - disabled), the corners are fitted on
+                          the small mask and scaled to the source image
+        model=NAME      — one of the preloaded models (REMBG_MODELS), default REMBG_MODEL
+
+    Request body: raw image bytes (Content-Type: application/octet-stream or image/*)
+    Request header X-Request-ID (optional) — ID to ask the state of the request in /queue/{request_id}
+    Request header X-Timeout (optional) — seconds to wait for the result, or X-Deadline — Unix time
+        of the deadline (default REMBG_TIMEOUT), after that the request is dropped with 504
+
+    Response:
+        corners: {"corners": [[x, y], ...], "width": W, "height": H} with corners in source image
+                 pixels ordered top-left, top-right, bottom-right, bottom-left
+        jpeg: the cover image (image/jpeg)
+        422 if no cover was found on the photo
+        X-Request-ID header contains the ID of the request
+        Server-Timing header contains the queue wait, decode, inference and postprocess
+            (mask, contour and corners) times in milliseconds, they are zero with cache;desc=hit
+            for a result taken from the cache
+        429 with Retry-After header if the queue is full (REMBG_MAX_QUEUE)
+        409 if a request with the same X-Request-ID is in the queue
+    """
+    request_id = get_request_id(request)
+    try:
+        deadline = get_deadline(request)
+    except ValueError:
+        return web.Response(status=400, text="Invalid X-Timeout or X-Deadline")
+    body = await read_body(request)
+    error = check_body(body)
+    if error:
+        return error
+    if warmup_error() is not None:
+        return web.Response(status=503, text="Models are not loaded")
+
+    try:
+        options = RemoveOptions(
+            only_mask=True,
+            max_side=int(request.query.get("max_side", MAX_SIDE)),
+            upscale=False,
+            format=request.query.get("format", "corners").lower(),
+            model=request.query.get("model", MODEL),
+        )
+    except ValueError:
+        return web.Response(status=400, text="Invalid max_side")
+    if options.format not in COVER_FORMATS:
+        return web.Response(status=400, text="Invalid format")
+    if options.model not in MODELS:
+        return web.Response(status=400, text="Unknown model")
+
+    log.info("Cover request %s: %d bytes, model=%s, max_side=%d, format=%s", request_id, len(body), options.model, options.max_side, options.format)
+
+    headers = {"X-Request-ID": request_id}
+    try:
+        result = await async_remove(body, options, request_id, time_left(deadline))
+    except ValueError as e:
+        log.warning("Cover not found: %s", e)
+        return web.Response(status=422, text=str(e), headers=headers)
+    except Exception as e:
+        response = overload_response(e, headers)
+        if response:
+            return response
+        log.exception("Error processing image")
+        return web.Response(status=500, text=str(e), headers=headers)
+    observe_image(result)
+    headers["Server-Timing"] = server_timing(result)
+    if options.format == "corners":
+        return web.Response(body=result.body, content_type="application/json", headers=headers)
+    return web.Response(body=result.body, content_type="image/jpeg", headers=headers)
 
 
 async def handle_queue(request: web.Request) -> web.Response:
-    """GET /queue — return current queue size as JSON."""
-    size = await get_queue_size()
-    return web.json_response({"queue_size": size})
+    """GET /queue — return the queue state and occupancy of every worker as JSON.
+
+    queue_size       — requests waiting or being processed
+    avg_inference_sec — rolling average of inference time per image (null before the first batch)
+    eta_sec          — estimated time to complete a request sent now (null before the first batch)
+    oldest_wait_sec  — how long the oldest request is in the queue
+    memory           — rss_bytes and peak_rss_bytes of the main process (workers have their own)
+    """
+    stats = _scheduler.stats() if _scheduler else {"queue_size": 0}
+    workers = _pool.stats() if _pool else []
+    return web.json_response({**stats, "memory": process_memory(os.getpid()), "workers": workers})
+
+
+async def handle_queue_request(request: web.Request) -> web.Response:
+    """GET /queue/{request_id} — return the state of the request as JSON.
+
+    state    — waiting or running
+    position — number of requests in the queue before this one
+    wait_sec — how long the request is in the queue
+    eta_sec  — estimated time to complete the request (null before the first batch)
+    404 if the request is unknown or already finished
+    """
+    status = _scheduler.status(request.match_info["request_id"]) if _scheduler else None
+    if status is None:
+        return web.json_response({"error": "Request not found"}, status=404)
+    return web.json_response(status)
+
+
+async def handle_cache(request: web.Request) -> web.Response:
+    """GET /cache — return result cache statistics as JSON."""
+    if _cache is None:
+        return web.json_response({"enabled": False})
+    return web.json_response({"enabled": True, **_cache.stats()})
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    """GET /metrics — metrics in Prometheus text format."""
+    QUEUE_SIZE.set(_scheduler.size() if _scheduler else 0)
+    BUSY_WORKERS.set(sum(1 for w in _pool.workers if w.busy) if _pool else 0)
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
 
 
 async def handle_health(request: web.Request) -> web.Response:
-    """GET /health — simple health check."""
-    return web.json_response({"status": "ok"})
+    """GET /health — simple health check, the service is alive even while warming up."""
+    return web.json_response({"status": "ok", "ready": is_ready()})
+
+
+async def handle_ready(request: web.Request) -> web.Response:
+    """GET /ready — readiness check: 200 once all models are loaded and warmed up in every worker,
+    503 before and while a died worker is restarting."""
+    if is_ready():
+        return web.json_response({"status": "ready", "models": MODELS, "default_model": MODEL})
+    error = warmup_error()
+    if error is not None:
+        return web.json_response({"status": "failed", "error": str(error)}, status=503)
+    if _warmup_task is not None and _warmup_task.done():
+        return web.json_response({"status": "restarting", "models": MODELS}, status=503)
+    return web.json_response({"status": "warming_up", "models": MODELS}, status=503)
 
 
 # ========================================================
 # App factory & startup
 # ========================================================
 
+async def warmup() -> None:
+    """Load and warm up the models in all workers, then start taking requests from the queue"""
+    started = time.monotonic()
+    try:
+        await _pool.start()
+    except Exception as e:
+        log.exception("Warmup failed")
+        _scheduler.fail_all(e)
+        raise
+    _scheduler.start()
+    log.info("Service is ready in %.1f s (models: %s)", time.monotonic() - started, ", ".join(MODELS))
+
+async def on_startup(app: web.Application) -> None:
+    global _pool, _scheduler, _cache, _warmup_task
+    if CACHE_MB > 0 or CACHE_DIR:
+        _cache = ResultCache(CACHE_MB * 1024 * 1024, CACHE_DIR, CACHE_DISK_MB * 1024 * 1024)
+    log.info("Starting %d worker process(es) with models %s ...", WORKERS, ", ".join(MODELS))
+    _pool = WorkerPool(WORKERS, MODELS, SESSION_SETTINGS)
+    # Requests arriving during the warmup wait in the queue
+    _scheduler = BatchScheduler(BATCH_MS, BATCH_MAX, _pool, LATENCY_WINDOW, MAX_QUEUE)
+    _warmup_task = asyncio.create_task(warmup())
+
+async def on_cleanup(app: web.Application) -> None:
+    if _warmup_task and not _warmup_task.done():
+        _warmup_task.cancel()
+    if _scheduler:
+        await _scheduler.stop()
+    if _pool:
+        _pool.shutdown()
+
 def create_app() -> web.Application:
-    app = web.Application(client_max_size=MAX_CONTENT_LENGTH)
+    app = web.Application(client_max_size=MAX_CONTENT_LENGTH, middlewares=[metrics_middleware])
     app.router.add_post("/remove", handle_remove)
+    app.router.add_post("/cover", handle_cover)
     app.router.add_get("/queue", handle_queue)
+    app.router.add_get("/queue/{request_id}", handle_queue_request)
+    app.router.add_get("/cache", handle_cache)
     app.router.add_get("/health", handle_health)
+    app.router.add_get("/ready", handle_ready)
+    app.router.add_get("/metrics", handle_metrics)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
     return app
 
 
+# ========================================================
+# Benchmark of ONNX Runtime settings
+# ========================================================
+
+# Source photos in directories given to the benchmark, like the example photos: cover1.jpg, 1.jpg
+BENCHMARK_PHOTO_NAME = re.compile(r"^(cover)?\d+\.jpe?g$", re.IGNORECASE)
+
+# Sessions of the current benchmark process by (model, settings), loaded once
+_benchmark_sessions: dict = {}
+
+def benchmark_worker(model: str, settings: SessionSettings, images: list[bytes], options: RemoveOptions, repeat: int) -> tuple[list[float], float]:
+    """Process the images with the model and the settings.
+
+    Returns seconds of every image processing and of the whole run, without
+    the loading and warmup of the session.
+    """
+    session = _benchmark_sessions.get((model, settings))
+    if session is None:
+        session = create_session(model, settings)
+        warmup_session(session)
+        _benchmark_sessions[(model, settings)] = session
+    latencies = []
+    run_started = time.perf_counter()
+    for _round in range(repeat):
+        for data in images:
+            started = time.perf_counter()
+            result = remove_batch(session, [(data, options)])[0]
+            latencies.append(time.perf_counter() - started)
+            if isinstance(result, Exception):
+                raise result
+    return latencies, time.perf_counter() - run_started
+
+def benchmark(argv: list[str]) -> None:
+    """Sweep ONNX Runtime settings on sample images and print the throughput.
+
+    Every combination of the settings is run in `--workers` processes at once,
+    like the service does, to show the effect of threads oversubscription.
+    """
+    def int_list(value: str) -> list[int]:
+        return [int(v) for v in value.split(",")]
+    def str_list(value: str) -> list[str]:
+        return value.split(",")
+    def bool_list(value: str) -> list[bool]:
+        return [v.lower() in ("true", "1", "yes") for v in value.split(",")]
+
+    cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(prog="homelib-rembg.py benchmark", description=benchmark.__doc__.splitlines()[0])
+    parser.add_argument("images", nargs="+", help="image files, or directories with photos named like cover1.jpg or 1.jpg")
+    parser.add_argument("--model", default=MODEL)
+    parser.add_argument("--workers", type=int_list, default=[WORKERS], help="worker processes, comma separated values to sweep")
+    parser.add_argument("--intra", type=int_list, default=sorted({1, max(1, cpus // 2), cpus}), help="intra-op threads")
+    parser.add_argument("--inter", type=int_list, default=[INTER_THREADS], help="inter-op threads")
+    parser.add_argument("--graph-opt", type=str_list, default=[GRAPH_OPT], help=", ".join(GRAPH_OPT_LEVELS))
+    parser.add_argument("--execution-mode", type=str_list, default=[EXECUTION_MODE], help=", ".join(EXECUTION_MODES))
+    parser.add_argument("--mem-arena", type=bool_list, default=[MEM_ARENA])
+    parser.add_argument("--max-side", type=int, default=MAX_SIDE, help="downscale the images before inference")
+    parser.add_argument("--repeat", type=int, default=1, help="process every image this many times")
+    args = parser.parse_args(argv)
+
+    paths = []
+    for path in args.images:
+        if os.path.isdir(path):
+            # Not the cut covers and masks saved next to the photos
+            paths += sorted(os.path.join(path, name) for name in os.listdir(path) if BENCHMARK_PHOTO_NAME.match(name))
+        else:
+            paths.append(path)
+    images = []
+    for path in paths:
+        with open(path, "rb") as f:
+            images.append(f.read())
+    if not images:
+        parser.error("no images found")
+    options = RemoveOptions(only_mask=True, max_side=args.max_side, upscale=False, format="rle", model=args.model)
+
+    print(f"{len(images)} images x {args.repeat}, model {args.model}, {cpus} CPUs")
+    print(f"{'workers':>7} {'intra':>5} {'inter':>5} {'graph_opt':>9} {'mode':>10} {'arena':>5} | {'img/s':>6} {'p50 s':>6} {'p95 s':>6}")
+    for workers, intra, inter, graph_opt, mode, arena in itertools.product(
+            args.workers, args.intra, args.inter, args.graph_opt, args.execution_mode, args.mem_arena):
+        settings = SessionSettings(intra_threads=intra, inter_threads=inter, graph_opt=graph_opt, execution_mode=mode, mem_arena=arena)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            # Load the models in the processes first, they keep the sessions for the measured runs
+            list(executor.map(benchmark_worker, *zip(*[(args.model, settings, images[:1], options, 1)] * workers)))
+            runs = list(executor.map(benchmark_worker, *zip(*[(args.model, settings, images, options, args.repeat)] * workers)))
+        # A process that got no preloading task loads the model in its run, its time is not measured
+        elapsed = max(seconds for _latencies, seconds in runs)
+        latencies = sorted(itertools.chain(*(latencies for latencies, _seconds in runs)))
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f"{workers:>7} {intra or 'def':>5} {inter or 'def':>5} {graph_opt:>9} {mode:>10} {str(arena):>5} | "
+              f"{len(latencies) / elapsed:>6.2f} {statistics.median(latencies):>6.3f} {p95:>6.3f}")
+
+
 if __name__ == "__main__":
-    log.info("Starting rembg service on %s:%d (model=%s)", HOST, PORT, MODEL)
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        benchmark(sys.argv[2:])
+        sys.exit(0)
+    log.info("Starting rembg service on %s:%d (model=%s, models=%s, workers=%d, batch=%dx%dms, max_queue=%d, timeout=%s)", HOST, PORT, MODEL, ",".join(MODELS), WORKERS, BATCH_MAX, BATCH_MS, MAX_QUEUE, TIMEOUT or "none")
+    log.info("ONNX Runtime settings: %s", SESSION_SETTINGS.describe())
+    if WORKERS > 1 and INTRA_THREADS == 0:
+        log.warning("Every of %d workers uses all %d CPUs, set REMBG_INTRA_THREADS to about %d to avoid threads oversubscription",
+                    WORKERS, os.cpu_count() or 1, max(1, (os.cpu_count() or 1) // WORKERS))
     app = create_app()
-    web.run_app(app, host=HOST, port=PORT)
+    # Cancel handlers of disconnected clients, so their requests leave the queue
+    web.run_app(app, host=HOST, port=PORT, handler_cancellation=True)
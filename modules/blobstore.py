@@ -0,0 +1,45 @@
+# ========================================================
+# Module for keeping photos between the messages of a user
+# ========================================================
+# Photos needed by later handlers (the first brief photo is sent to the VLM
+# together with the second one) are kept here instead of the FSM state, which
+# is a JSON column rewritten on every update. The state keeps only the key.
+# Photos are kept in memory and on local disk, see lru_store.
+# ========================================================
+
+import os # For environment variables
+import tempfile # For the default directory
+
+import modules.lru_store as lru # For the memory and disk tiers
+
+# ========================================================
+# Configuration data
+# ========================================================
+
+BLOB_CACHE_MB = int(os.getenv("BLOB_CACHE_MB", "64")) # Memory tier size
+BLOB_DIR = os.getenv("BLOB_DIR", os.path.join(tempfile.gettempdir(), "homelib-blobs")) # Disk tier directory (empty - disabled)
+BLOB_DISK_MB = int(os.getenv("BLOB_DISK_MB", "512")) # Disk tier size
+
+# ========================================================
+# Environment variables
+# ========================================================
+
+store: lru.LruStore | None = None  # Store of the bot
+
+# ========================================================
+# Open the store
+# ========================================================
+def init() -> lru.LruStore:
+    global store
+    if store is None:
+        store = lru.LruStore(BLOB_CACHE_MB * 2**20, BLOB_DIR, BLOB_DISK_MB * 2**20)
+    return store
+
+async def put(key: str, data: bytes) -> None:
+    await init().put(key, data)
+
+async def get(key: str) -> bytes | None:
+    return await init().get(key)
+
+async def delete(key: str) -> None:
+    await init().delete(key)
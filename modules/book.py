@@ -10,7 +10,6 @@ import modules.web as web # For web-related functions and definitions
 import modules.h_start as h_start # For handling start command
 
 import random # For random choices
-import aiohttp # For async HTTP requests
 from datetime import datetime # For handling date and time
 import csv # For CSV handling
 import json # For JSON handling
@@ -118,19 +117,17 @@ async def PrintBooksList(rows: list, state: eng.FSMContext, event_chat: eng.Chat
             elif photo:
                 photo_url = web.AWS_EXTERNAL_URL + "/" + photo
                 # Download books cover from S3 storage
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(photo_url, timeout=aiohttp.ClientTimeout(total=eng.HTTP_TIMEOUT_sec)) as resp:
-                        resp.raise_for_status()
-                        photo_bytes = await resp.read()
+                async with eng.http_session().get(photo_url) as resp:
+                    resp.raise_for_status()
+                    photo_bytes = await resp.read()
                 message = await eng.send_photo_from_bytes(event_chat.id, photo_bytes=photo_bytes, filename=photo, caption=caption, parse_mode=eng.ParseMode.HTML)
-                photo = await message.get_photo()
                 # Update loaded to messenger cover token in the database
                 async with db.pool.acquire() as conn:
                     await conn.execute("""
                         UPDATE books
                         SET cover_token = $1
                         WHERE book_id = $2 AND user_id = $3 AND platform = $4
-                    """, photo.token, book_id, event_from_user.id, eng.MESSENGER)
+                    """, message.get_photo_token(), book_id, event_from_user.id, eng.MESSENGER)
             else:
                 message = await eng.send_message(event_chat.id, caption, parse_mode=eng.ParseMode.HTML)
             await eng.send_inline_keyboard(message, keyboard, state, 1, eng.onButtonClick.KeepKeyboardAndMessage)
@@ -0,0 +1,70 @@
+# Module with pure image functions to prepare the brief photos for the Vision LLM
+# Smaller images are uploaded faster and cost less vision tokens, so the photos
+# are downscaled and recompressed, and optionally cropped to the page, made
+# grayscale and stitched side by side into one image
+
+import numpy as np # For arrays processing
+import cv2 # For image processing
+
+import modules.cover_geometry as geo # For finding the page on the photo
+
+CROP_CONFIDENCE = 0.8 # Minimal confidence of the found page to crop the photo to it
+
+# =========================================================
+# Decode the photo and prepare it
+def prepare_image(photo_bytes: bytes, max_side: int, crop: bool = False, grayscale: bool = False) -> tuple[np.ndarray, bool]:
+    """Return the photo cropped to the page (if found with confidence), grayscale
+    and downscaled to `max_side` pixels on the longest side (0 - not downscaled),
+    and whether it was downscaled
+    """
+    image = cv2.imdecode(np.frombuffer(photo_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Cannot decode the photo")
+    if crop:
+        found = geo.detect_cover(photo_bytes)
+        if found and found[1] >= CROP_CONFIDENCE:
+            image = geo.warp_cover(image, found[0])
+    if grayscale:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    height, width = image.shape[:2]
+    if max_side and max(width, height) > max_side:
+        scale = max_side / max(width, height)
+        image = cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+        return image, True
+    return image, False
+
+# =========================================================
+# Put the images side by side at the same height
+def stitch_images(images: list[np.ndarray]) -> np.ndarray:
+    height = min(image.shape[0] for image in images)
+    # Grayscale and color images can not be concatenated
+    if any(image.ndim == 3 for image in images):
+        images = [cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if image.ndim == 2 else image for image in images]
+    resized = []
+    for image in images:
+        if image.shape[0] != height:
+            width = round(image.shape[1] * height / image.shape[0])
+            image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+        resized.append(image)
+    return cv2.hconcat(resized)
+
+# =========================================================
+# Prepare the brief photos and encode them to JPEG
+def prepare_brief(photos: list[bytes], max_side: int, quality: int, crop: bool = False, grayscale: bool = False, stitch: bool = False) -> list[bytes]:
+    """Return the JPEG images to send to the Vision LLM: one per photo, or one stitched image"""
+    prepared = [prepare_image(photo_bytes, max_side, crop, grayscale) for photo_bytes in photos]
+    images = [image for image, _downscaled in prepared]
+    stitched = stitch and len(images) > 1
+    if stitched:
+        images = [stitch_images(images)]
+    result = []
+    for i, image in enumerate(images):
+        is_success, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not is_success:
+            raise ValueError("Cannot encode the photo")
+        jpeg = buffer.tobytes()
+        # A small photo already compressed stronger is sent as it is
+        if not (stitched or crop or grayscale or prepared[i][1]) and len(photos[i]) <= len(jpeg):
+            jpeg = photos[i]
+        result.append(jpeg)
+    return result
@@ -15,4 +15,20 @@ GPT_MODEL = os.getenv("GPT_MODEL")
 
 # Rembg service URL
 REMBG_URL = os.getenv("REMBG_URL")
+# Longest side of the photo copy sent to rembg service, the corners are refined on the full photo (0 - send the full photo)
+REMBG_PYRAMID_SIDE = int(os.getenv("REMBG_PYRAMID_SIDE", "1024"))
 
+# Local cover detector: its cover is used without rembg service with this confidence (above 1 - never)
+LOCAL_COVER_CONFIDENCE = float(os.getenv("LOCAL_COVER_CONFIDENCE", "0.8"))
+# ... or with this confidence, when rembg service is busy or fails
+LOCAL_COVER_BUSY_CONFIDENCE = float(os.getenv("LOCAL_COVER_BUSY_CONFIDENCE", "0.5"))
+# Rembg service is busy with this number of requests in the queue or this estimated time of a new request
+REMBG_BUSY_QUEUE = int(os.getenv("REMBG_BUSY_QUEUE", "8"))
+REMBG_BUSY_ETA_sec = float(os.getenv("REMBG_BUSY_ETA", "10"))
+# Brief photos sent to the Vision LLM: longest side (0 - not downscaled) and JPEG quality
+VLM_IMAGE_SIDE = int(os.getenv("VLM_IMAGE_SIDE", "1600"))
+VLM_IMAGE_QUALITY = int(os.getenv("VLM_IMAGE_QUALITY", "85"))
+# ... cropped to the page when it is found, made grayscale, two pages stitched side by side into one image
+VLM_IMAGE_CROP = os.getenv("VLM_IMAGE_CROP", "false").lower() in ("true", "1", "yes")
+VLM_IMAGE_GRAYSCALE = os.getenv("VLM_IMAGE_GRAYSCALE", "false").lower() in ("true", "1", "yes")
+VLM_IMAGE_STITCH = os.getenv("VLM_IMAGE_STITCH", "false").lower() in ("true", "1", "yes")
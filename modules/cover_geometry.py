@@ -0,0 +1,323 @@
+# Module with pure geometry functions to find the book cover on the mask or on the photo and cut it from the photo
+# Used by the bot and by the rembg service, so it depends only on numpy and OpenCV
+
+import time # For measuring the stages
+import numpy as np # For arrays processing
+import cv2 # For image processing
+
+# =========================================================
+# Calculate distance between two points
+def distance(p1, p2):
+    return np.sqrt((p1[0] - p2[0])**2 + (p1[1] - p2[1])**2)
+
+# =========================================================
+# Clean up the binary mask and find the largest contour on it
+def largest_contour(binary_mask: np.ndarray) -> np.ndarray:
+    """Return the largest external contour of the binary (0/255) mask.
+
+    Raises:
+        ValueError: if there are no contours on the mask.
+    """
+    # Apply morphological operations to clean up the mask
+    kernel = np.ones((5, 5), np.uint8)
+    # Close small holes in the mask
+    binary_mask = cv2.morphologyEx(binary_mask, cv2.MORPH_CLOSE, kernel, iterations=2)
+    # Remove small noise outside the mask
+    binary_mask = cv2.morphologyEx(binary_mask, cv2.MORPH_OPEN, kernel, iterations=2)
+    # Find contours
+    contours, _none = cv2.findContours(binary_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        raise ValueError("No contours found on the mask")
+    return max(contours, key=cv2.contourArea)
+
+# =========================================================
+# Approximate the contour with a quadrilateral
+
+# Range of approxPolyDP epsilon relative to the contour perimeter
+EPSILON_FACTORS = np.arange(0.02, 0.15, 0.005)
+
+def approximate_quadrilateral(contour: np.ndarray) -> np.ndarray | None:
+    """Return approxPolyDP of the contour with 4 vertices at the smallest epsilon
+    of EPSILON_FACTORS, or None if there is no such epsilon.
+
+    The number of vertices decreases as epsilon grows, so the smallest epsilon
+    is found by bisection in a few approxPolyDP calls instead of trying all of them.
+    """
+    perimeter = cv2.arcLength(contour, True)
+    def approximate(index: int) -> np.ndarray:
+        return cv2.approxPolyDP(contour, EPSILON_FACTORS[index] * perimeter, True)
+
+    # Find the first epsilon with at most 4 vertices
+    low, high = 0, len(EPSILON_FACTORS) - 1
+    found = None
+    while low <= high:
+        middle = (low + high) // 2
+        approx = approximate(middle)
+        if len(approx) <= 4:
+            found = (middle, approx)
+            high = middle - 1
+        else:
+            low = middle + 1
+    if found is None:
+        return None
+    index, approx = found
+    # Rarely the number of vertices jumps over 4 and comes back with bigger epsilon
+    while len(approx) < 4 and index + 1 < len(EPSILON_FACTORS):
+        index += 1
+        approx = approximate(index)
+    return approx if len(approx) == 4 else None
+
+def fit_quadrilateral(contour: np.ndarray) -> np.ndarray:
+    """Return 4 points (4x2 float32) approximating the contour"""
+    quadrilateral = approximate_quadrilateral(contour)
+    # If the contour has no 4 clear corners, look for them on its convex hull
+    if quadrilateral is None:
+        quadrilateral = approximate_quadrilateral(cv2.convexHull(contour))
+    # If no quadrilateral found, use minimum area rectangle arround the contour
+    if quadrilateral is None:
+        rect_tuple = cv2.minAreaRect(contour)
+        quadrilateral = cv2.boxPoints(rect_tuple).astype(np.int32)
+
+    return quadrilateral.reshape(4, 2).astype(np.float32)
+
+# =========================================================
+# Order points: top-left, top-right, bottom-right, bottom-left
+def order_points(pts: np.ndarray) -> np.ndarray:
+    rect = np.zeros((4, 2), dtype=np.float32)
+    # First sort by sum of coordinates
+    s = pts.sum(axis=1)
+    rect[0] = pts[np.argmin(s)]  # top-left (min sum)
+    rect[2] = pts[np.argmax(s)]  # bottom-right (max sum)
+    # Remain two points sort by difference of coordinates
+    diff = np.diff(pts, axis=1)
+    rect[1] = pts[np.argmin(diff)]  # top-right (min difference)
+    rect[3] = pts[np.argmax(diff)]  # bottom-left (max difference)
+    return rect
+
+# =========================================================
+# Find ordered corners of the book cover on the binary mask
+def find_corners(binary_mask: np.ndarray) -> np.ndarray:
+    """Return corners (4x2 float32) of the cover in mask coordinates:
+    top-left, top-right, bottom-right, bottom-left.
+
+    Raises:
+        ValueError: if nothing is found on the mask.
+    """
+    return order_points(fit_quadrilateral(largest_contour(binary_mask)))
+
+# =========================================================
+# Pyramid mode: the cover is found on a downscaled copy of the photo,
+# then its corners are scaled back and refined on the full-size photo
+
+# Points sampled along every side of the cover to find its edge
+REFINE_SAMPLES = 32
+# Minimal brightness step (per pixel across the edge) to trust a sample
+REFINE_MIN_CONTRAST = 4.0
+
+def downscale_jpeg(photo_bytes: bytes, max_side: int) -> tuple[bytes, tuple[int, int]] | None:
+    """Return the photo downscaled to `max_side` pixels on the longest side as JPEG
+    and the size (width, height) of the full photo, or None if the photo is not larger.
+    """
+    original = cv2.imdecode(np.frombuffer(photo_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if original is None:
+        raise ValueError("Cannot decode the photo")
+    height, width = original.shape[:2]
+    scale = max_side / max(width, height)
+    if scale >= 1:
+        return None
+    small = cv2.resize(original, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    del original
+    is_success, buffer = cv2.imencode('.jpg', small, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    if not is_success:
+        raise ValueError("Cannot encode the photo")
+    return buffer.tobytes(), (width, height)
+
+def scale_corners(rect: np.ndarray, size: tuple[int, int], full_size: tuple[int, int]) -> np.ndarray:
+    """Scale corners from pixels of the image of `size` to pixels of the image of `full_size` (width, height)"""
+    rect = np.array(rect, dtype=np.float32)
+    rect[:, 0] = (rect[:, 0] + 0.5) * full_size[0] / size[0] - 0.5
+    rect[:, 1] = (rect[:, 1] + 0.5) * full_size[1] / size[1] - 0.5
+    return rect
+
+def _edge_line(gray: np.ndarray, p0: np.ndarray, p1: np.ndarray, radius: int) -> tuple[np.ndarray, np.ndarray]:
+    """Return the line (point, direction) of the strongest edge near the side p0-p1,
+    or the side itself if the edge is not clear.
+    """
+    length = distance(p0, p1)
+    direction = (p1 - p0) / max(length, 1e-6)
+    if length <= 4 * radius:
+        return p0, direction
+    normal = np.array([-direction[1], direction[0]], dtype=np.float32)
+    # Sample across the side away from the corners, where the neighbour sides are
+    margin = 2 * radius / length
+    t = np.linspace(margin, 1 - margin, REFINE_SAMPLES, dtype=np.float32)
+    points = p0 + t[:, None] * (p1 - p0)
+    offsets = np.arange(-radius, radius + 1, dtype=np.float32)
+    grid = points[:, None, :] + offsets[None, :, None] * normal
+    profiles = cv2.remap(gray, grid[..., 0], grid[..., 1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    # The edge is the strongest brightness step across the side,
+    # its subpixel position is the top of the parabola through the neighbour steps
+    steps = np.abs(np.diff(profiles, axis=1))
+    rows = np.arange(len(steps))
+    best = np.clip(steps.argmax(axis=1), 1, steps.shape[1] - 2)
+    left, center, right = steps[rows, best - 1], steps[rows, best], steps[rows, best + 1]
+    curvature = left - 2 * center + right
+    shift = np.where(curvature < 0, 0.5 * (left - right) / np.where(curvature < 0, curvature, -1), 0)
+    position = offsets[best] + 0.5 + np.clip(shift, -0.5, 0.5)
+    keep = center >= REFINE_MIN_CONTRAST
+    if keep.sum() < REFINE_SAMPLES // 2:
+        return p0, direction
+    edge = (points[keep] + position[keep, None] * normal).astype(np.float32)
+    vx, vy, x0, y0 = cv2.fitLine(edge, cv2.DIST_HUBER, 0, 0.01, 0.01).ravel()
+    return np.array([x0, y0], dtype=np.float32), np.array([vx, vy], dtype=np.float32)
+
+def refine_corners(gray: np.ndarray, rect: np.ndarray, radius: int) -> np.ndarray:
+    """Move ordered corners `rect` to the intersections of the cover edges found
+    on the grayscale image within `radius` pixels from its sides.
+
+    A corner stays in place if the edges near it are not clear or move it too far.
+    """
+    gray = cv2.GaussianBlur(gray.astype(np.float32), (0, 0), 1.0)
+    rect = np.asarray(rect, dtype=np.float32)
+    lines = [_edge_line(gray, rect[i], rect[(i + 1) % 4], radius) for i in range(4)]
+    refined = rect.copy()
+    for i in range(4):
+        # Corner i is the end of side i-1 and the start of side i
+        (a, a_direction), (b, b_direction) = lines[i - 1], lines[i]
+        matrix = np.array([a_direction, -b_direction]).T
+        if abs(np.linalg.det(matrix)) < 1e-6:
+            continue
+        s, _u = np.linalg.solve(matrix, b - a)
+        point = a + s * a_direction
+        if distance(point, rect[i]) <= 2 * radius:
+            refined[i] = point
+    return refined
+
+# =========================================================
+# Classical cover detector without a segmentation model: the cover is the
+# largest convex quadrilateral outlined by the edges of the photo.
+# Works on easy photos: a book on a plain contrast surface.
+
+DETECT_MAX_SIDE = 640 # Longest side of the photo copy to find the edges on
+DETECT_CANDIDATES = 10 # How many largest contours to try
+DETECT_MIN_AREA = 0.1 # Minimal area of the cover relative to the photo
+DETECT_MIN_ANGLE = 60 # Minimal angle of the cover corners in degrees
+DETECT_REFINE_px = 3 # Refine radius in pixels of the photo copy
+
+def _edge_support(edges: np.ndarray, quadrilateral: np.ndarray) -> float:
+    """Fraction of the outline lying on the edges for the worst side of the quadrilateral"""
+    support = 1.0
+    for i in range(4):
+        outline = np.zeros_like(edges)
+        cv2.line(outline, tuple(int(v) for v in quadrilateral[i]), tuple(int(v) for v in quadrilateral[(i + 1) % 4]), 255, 1)
+        total = np.count_nonzero(outline)
+        support = min(support, np.count_nonzero(cv2.bitwise_and(outline, edges)) / total if total else 0.0)
+    return support
+
+def _min_angle(quadrilateral: np.ndarray) -> float:
+    """Smallest interior angle of the quadrilateral in degrees"""
+    angles = []
+    for i in range(4):
+        a = quadrilateral[i - 1] - quadrilateral[i]
+        b = quadrilateral[(i + 1) % 4] - quadrilateral[i]
+        cosine = np.dot(a, b) / max(np.linalg.norm(a) * np.linalg.norm(b), 1e-6)
+        angles.append(np.degrees(np.arccos(np.clip(cosine, -1, 1))))
+    return min(angles)
+
+def detect_cover(photo_bytes: bytes) -> tuple[np.ndarray, float] | None:
+    """Find the cover on the photo by its edges.
+
+    Return ordered corners (4x2 float32) in the photo pixels and the confidence
+    from 0 to 1 that they are the cover, or None if no quadrilateral is found.
+    """
+    gray = cv2.imdecode(np.frombuffer(photo_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise ValueError("Cannot decode the photo")
+    height, width = gray.shape
+    scale = min(1.0, DETECT_MAX_SIDE / max(width, height))
+    small = cv2.resize(gray, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    small = cv2.GaussianBlur(small, (5, 5), 0)
+    # Thresholds of the edges from the median brightness of the photo
+    median = float(np.median(small))
+    edges = cv2.Canny(small, int(max(0, 0.66 * median)), int(min(255, 1.33 * median)))
+    # Close the gaps in the outline of the cover
+    closed = cv2.dilate(edges, np.ones((3, 3), np.uint8), iterations=1)
+    contours, _none = cv2.findContours(closed, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    # The sides of the cover may be a pixel or two away from the found edges
+    tolerance = cv2.dilate(edges, np.ones((5, 5), np.uint8), iterations=1)
+
+    image_area = small.shape[0] * small.shape[1]
+    hulls = sorted((cv2.convexHull(contour) for contour in contours), key=cv2.contourArea, reverse=True)
+    best = None
+    for hull in hulls[:DETECT_CANDIDATES]:
+        quadrilateral = approximate_quadrilateral(hull)
+        if quadrilateral is None:
+            continue
+        quadrilateral = order_points(quadrilateral.reshape(4, 2).astype(np.float32))
+        if cv2.contourArea(quadrilateral) < DETECT_MIN_AREA * image_area or _min_angle(quadrilateral) < DETECT_MIN_ANGLE:
+            continue
+        # A cover touching the borders of the photo is probably cut, or it is not a cover at all
+        margin = 2
+        inside = (quadrilateral.min() >= margin
+                  and quadrilateral[:, 0].max() <= small.shape[1] - 1 - margin
+                  and quadrilateral[:, 1].max() <= small.shape[0] - 1 - margin)
+        # All sides of the cover should follow the edges of the photo
+        confidence = _edge_support(tolerance, quadrilateral) * (1.0 if inside else 0.5)
+        if best is None or confidence > best[1]:
+            best = (quadrilateral, confidence)
+    if best is None:
+        return None
+
+    quadrilateral, confidence = best
+    rect = scale_corners(quadrilateral, (small.shape[1], small.shape[0]), (width, height))
+    if scale < 1:
+        rect = refine_corners(gray, rect, int(np.ceil(DETECT_REFINE_px / scale)) + 2)
+    return rect, float(confidence)
+
+# =========================================================
+# Cut the quadrilateral from the image and align it to a rectangle
+def warp_cover(image: np.ndarray, rect: np.ndarray) -> np.ndarray:
+    """Apply perspective transformation of ordered corners `rect` to an upright rectangle"""
+    # Compute width and height of the output quadrilateral
+    width = int(max(distance(rect[0], rect[1]), distance(rect[2], rect[3])))
+    height = int(max(distance(rect[0], rect[3]), distance(rect[1], rect[2])))
+    if width < 2 or height < 2:
+        raise ValueError("Cover is too small")
+    dst = np.array([
+        [0, 0],
+        [width - 1, 0],
+        [width - 1, height - 1],
+        [0, height - 1]
+    ], dtype=np.float32)
+    # Compute perspective transformation matrix and apply it
+    M = cv2.getPerspectiveTransform(rect.astype(np.float32), dst)
+    return cv2.warpPerspective(image, M, (width, height))
+
+# =========================================================
+# Decode the photo, cut the cover by its corners and encode it to JPEG
+def cut_cover_jpeg(photo_bytes: bytes, rect: np.ndarray, refine_radius: int = 0) -> bytes:
+    """With `refine_radius`, the corners found on a downscaled photo are refined on the full one first"""
+    return cut_cover_timed(photo_bytes, rect, refine_radius)[0]
+
+def cut_cover_timed(photo_bytes: bytes, rect: np.ndarray, refine_radius: int = 0) -> tuple[bytes, dict]:
+    """Same as cut_cover_jpeg, also return durations of its stages in seconds"""
+    timings = {}
+    started = time.perf_counter()
+    original = cv2.imdecode(np.frombuffer(photo_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if original is None:
+        raise ValueError("Cannot decode the photo")
+    timings["decode"] = time.perf_counter() - started
+    if refine_radius > 0:
+        started = time.perf_counter()
+        rect = refine_corners(cv2.cvtColor(original, cv2.COLOR_BGR2GRAY), rect, refine_radius)
+        timings["refine"] = time.perf_counter() - started
+    started = time.perf_counter()
+    warped = warp_cover(original, rect)
+    del original
+    timings["warp"] = time.perf_counter() - started
+    started = time.perf_counter()
+    is_success, buffer = cv2.imencode('.jpg', warped)
+    if not is_success:
+        raise ValueError("Cannot encode the cover")
+    timings["encode"] = time.perf_counter() - started
+    return buffer.tobytes(), timings
@@ -89,7 +89,12 @@ from maxapi.enums.attachment import AttachmentType as AttachmentType_max
 # Constants and settings
 # ========================================================
 
-HTTP_TIMEOUT_sec = 20 # Timeout for HTTP requests in seconds
+HTTP_TIMEOUT_sec = int(os.getenv("HTTP_TIMEOUT", "20")) # Timeout for HTTP requests in seconds
+HTTP_CONNECT_TIMEOUT_sec = int(os.getenv("HTTP_CONNECT_TIMEOUT", "5")) # Timeout for connection setup in seconds
+HTTP_LIMIT = int(os.getenv("HTTP_LIMIT", "100")) # Maximum of simultaneous connections of the HTTP client
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "20")) # Maximum of simultaneous connections to one host (rembg, S3, MAX media)
+HTTP_KEEPALIVE_sec = int(os.getenv("HTTP_KEEPALIVE", "30")) # How long idle connections are kept open
+HTTP_DNS_CACHE_sec = int(os.getenv("HTTP_DNS_CACHE", "300")) # How long resolved host names are cached
 
 # ========================================================
 # Configuration data
@@ -104,6 +109,7 @@ MESSENGER_PROXY: str = None # Placeholder for messenger token
 # ========================================================
 
 bot: Bot_tg | Bot_max = None  # Placeholder for bot instance
+http: aiohttp.ClientSession = None  # Placeholder for shared HTTP client instance
 storage: PostgresStorage_tg | PostgresStorage_max = None  # Placeholder for storage instance
 dp: Dispatcher_tg | Dispatcher_max = None  # Placeholder for dispatcher instance
 
@@ -241,11 +247,23 @@ class Message:
                 if self.message_max.body.attachments[0].type != "image":
                     raise ValueError("The attachment is not a photo")
                 photo_url = self.message_max.body.attachments[0].payload.url
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(photo_url, timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT_sec)) as resp:
-                        resp.raise_for_status()
-                        photo_bytes = await resp.read()
-                        return Attachment(body=photo_bytes, url=photo_url, token=self.message_max.body.attachments[0].payload.token)
+                async with http_session().get(photo_url) as resp:
+                    resp.raise_for_status()
+                    photo_bytes = await resp.read()
+                    return Attachment(body=photo_bytes, url=photo_url, token=self.message_max.body.attachments[0].payload.token)
+            else:
+                raise ValueError("No attachments found in the message")
+    def get_photo_token(self) -> str:
+        """ Get the token of the photo from the message metadata, without downloading the photo."""
+        if MESSENGER == b'T':
+            if not self.message_tg.photo:
+                raise ValueError("No photo found in the message")
+            return self.message_tg.photo[-1].file_id
+        elif MESSENGER == b'M':
+            if self.message_max.body.attachments:
+                if self.message_max.body.attachments[0].type != "image":
+                    raise ValueError("The attachment is not a photo")
+                return self.message_max.body.attachments[0].payload.token
             else:
                 raise ValueError("No attachments found in the message")
     async def set_like(self) -> None:
@@ -357,6 +375,30 @@ def init_bot(messenger: str, postgres_config: dict, _only_user: str = None, _exc
         MaxCharsInMessage = 4096 # It works both
         MaxButtonsInMessage = 30 # 30+ buttons got empty message in Max.
 
+# -------------------------------------------------------
+def http_session() -> aiohttp.ClientSession:
+    """ Shared HTTP client for rembg service, S3 downloads and MAX media.
+
+        Keeps connections alive between requests, so TCP and TLS setup is paid once per host.
+        Created on first use, because aiohttp needs the running event loop.
+    """
+    global http
+    if http is None or http.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_LIMIT,
+                                         limit_per_host=HTTP_LIMIT_PER_HOST,
+                                         keepalive_timeout=HTTP_KEEPALIVE_sec,
+                                         ttl_dns_cache=HTTP_DNS_CACHE_sec)
+        timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT_sec, connect=HTTP_CONNECT_TIMEOUT_sec)
+        http = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return http
+
+async def close_http_session() -> None:
+    """ Close the shared HTTP client on shutdown."""
+    global http
+    if http is not None:
+        await http.close()
+        http = None
+
 # -------------------------------------------------------
 def init_router():
     """ Initialize routers based on the current messenger.
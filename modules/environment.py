@@ -38,8 +38,9 @@ class State(eng.StatesGroup):
 #             [ "add_book", "search", "rename_category", "edit_book", "select_language" ]
 # category: str - selected category name
 # field: str - currently selected book field for editing
-# brief_base64: str - base64 of the uploaded brief photo
-# brief2_base64: str - base64 of the uploaded brief photo
+# brief_blob: str - key of the first brief photo in the blob store (its S3 filename)
+# brief2_blob: str - key of the second brief photo in the blob store (its S3 filename)
+# stage_seconds: dict[str, float] - durations of the stages of adding the current book
 # photo_token: str - messenger token of the user's uploaded book cover photo
 
 # Data of the book fields:
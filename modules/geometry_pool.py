@@ -0,0 +1,63 @@
+# ========================================================
+# Module for running CPU-heavy image processing off the event loop
+# ========================================================
+# Decoding photos, finding contours and perspective transformations take
+# hundreds of milliseconds on large photos. Run on the asyncio loop, they
+# stall the updates of all other users, so handlers await them in a pool.
+# ========================================================
+
+import os # For environment variables
+import asyncio # For awaiting the pool from handlers
+import logging # For logging
+import multiprocessing # For the start method of worker processes
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor # For the pool
+
+# ========================================================
+# Configuration data
+# ========================================================
+
+# Size of the pool
+GEOMETRY_WORKERS = max(1, int(os.getenv("GEOMETRY_WORKERS", "2")))
+# thread - OpenCV and numpy release the GIL, so threads run in parallel without copying photos between processes
+# process - full isolation from the bot process, photos are copied to the workers
+GEOMETRY_POOL = os.getenv("GEOMETRY_POOL", "thread")
+
+# ========================================================
+# Environment variables
+# ========================================================
+
+pool: Executor | None = None  # Pool of threads or processes
+
+# ========================================================
+# Create the pool
+# ========================================================
+def init() -> Executor:
+    global pool
+    if pool is None:
+        if GEOMETRY_POOL == "process":
+            # Spawn: the pool starts on the first photo, when the bot already has threads and open
+            # connections, and fork of such a process may deadlock. Spawned workers import the main
+            # module of the bot as __mp_main__, which only imports the modules: the bot, its storage
+            # and routers are created in main(), which is not run there
+            pool = ProcessPoolExecutor(max_workers=GEOMETRY_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        else:
+            pool = ThreadPoolExecutor(max_workers=GEOMETRY_WORKERS, thread_name_prefix="geometry")
+        logging.info(f"Geometry pool: {GEOMETRY_WORKERS} {GEOMETRY_POOL} worker(s)")
+    return pool
+
+# ========================================================
+# Run the function in the pool and wait for its result
+# ========================================================
+async def run(func, *args):
+    """The function and its arguments must be picklable for the process pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(init(), func, *args)
+
+# ========================================================
+# Stop the pool
+# ========================================================
+def close() -> None:
+    global pool
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+        pool = None
@@ -6,17 +6,21 @@ import modules.actions as act # For bot commands and actions
 import modules.environment as env # For bot states and callback data factories
 import modules.common as com # For common functions and definitions
 import modules.book as book # For save book to database
+import modules.s3storage as s3 # For uploading photos to S3 storage
+import modules.blobstore as blobs # For keeping brief photos between messages
+import modules.stages as stg # For timing the stages of adding a book
+import modules.geometry_pool as gp # For preparing the photos off the event loop
+import modules.brief_image as bi # For downscaling the photos for the VLM
+import modules.vlm as vlm # For asking the Vision LLM
 
 import modules.h_edit as h_edit # For editing book information
 import modules.h_cover as h_cover # For do book cover photos
 import modules.h_start as h_start # For handling start command
 
+import asyncio # For running the upload and the VLM request concurrently
 import logging # For logging
 import uuid # For generating unique filenames
-import aioboto3 # For AWS S3 storage
-import io # For handling byte streams
 import base64 # For encoding and decoding base64
-from openai import AsyncOpenAI # For OpenAI API client
 
 # =========================================================
 # Ask user for the photo of the first page of the book with annotation
@@ -45,6 +49,62 @@ async def take_two_brief_photos(message: eng.Message, callback: eng.CallbackData
     # Set the state to wait for the first brief photo
     await state.set_state(env.State.wait_for_brief_photo1of2)
 
+# =========================================================
+# Save the filename of the uploaded brief photo in the state, or report the upload error
+async def save_upload(message: eng.Message, state: eng.FSMContext, current_state: str, upload_result: str | BaseException) -> None:
+    if isinstance(upload_result, BaseException):
+        await message.reply(_("upload_failed"))
+        logging.error(f"Error uploading to S3: {upload_result}")
+        return
+    if current_state == env.State.wait_for_brief_photo2of2:
+        await state.update_data(brief2_filename=upload_result) # Save the filename in the state
+    else:
+        await state.update_data(brief_filename=upload_result) # Save the filename in the state
+    await message.set_like() # Give like to user's photo
+
+# =========================================================
+# Get the brief photo ("brief" or "brief2") from the blob store, or from S3 storage if it is not there
+async def load_brief(data: dict, page: str) -> bytes:
+    key = data.get(f"{page}_blob")
+    if key:
+        photo_body = await blobs.get(key)
+        if photo_body is None:
+            photo_body = await s3.download(key)
+        return photo_body
+    # States saved before the blob store keep the photo itself, or at least its S3 filename
+    if data.get(f"{page}_base64"):
+        return base64.b64decode(data[f"{page}_base64"])
+    if data.get(f"{page}_filename"):
+        return await s3.download(data[f"{page}_filename"])
+    raise ValueError("No brief photo in the state")
+
+# =========================================================
+# Ask the Vision LLM to extract book information from the brief photos in the state
+async def ask_vlm(state: eng.FSMContext, current_state: str, timer: stg.StageTimer):
+    # Ask GPT-4 Vision to analyze the image and extract book information
+    prompt = ""
+    for line in act.BOOK_PROMPT:
+        prompt = prompt + _(line) + "\n"
+    data = await state.get_data()
+    pages = ["brief"]
+    if current_state == env.State.wait_for_brief_photo2of2:
+        pages.append("brief2")
+    photos = [await load_brief(data, page) for page in pages]
+    # Downscale and recompress the photos to upload less and spend less vision tokens
+    images = await timer.measure("vlm_prepare", gp.run(bi.prepare_brief, photos, com.VLM_IMAGE_SIDE, com.VLM_IMAGE_QUALITY,
+                                                       com.VLM_IMAGE_CROP, com.VLM_IMAGE_GRAYSCALE, com.VLM_IMAGE_STITCH))
+    logging.debug(f"Brief photos for VLM: {sum(map(len, photos))} -> {sum(map(len, images))} bytes")
+    VLM_messages = []
+    for image in images:
+        photo_base64 = base64.b64encode(image).decode('utf-8')
+        VLM_messages = VLM_messages + [
+                {"role": "user", "content": [ {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{photo_base64}"} } ] }
+            ]
+    VLM_messages = VLM_messages + [
+            {"role": "user", "content": [ {"type": "text", "text": prompt} ] }
+        ]
+    return await timer.measure("vlm", vlm.complete(VLM_messages, max_tokens=2000))
+
 # =========================================================
 # Handler for sended photo of the first page of the book with annotation
 @eng.on_message(eng.base_router,env.State.wait_for_brief_photo1of1, eng.F_photo())
@@ -53,36 +113,37 @@ async def take_two_brief_photos(message: eng.Message, callback: eng.CallbackData
 @eng.message_handler
 async def brief_photo(message: eng.Message, state: eng.FSMContext, event_chat: eng.Chat, event_from_user: eng.User) -> None:
 
+    # The first of two photos moves to waiting for the second one before anything else is awaited,
+    # so a quick second photo is not taken for the first one
+    current_state = await state.get_state()
+    if current_state == env.State.wait_for_brief_photo1of2:
+        await state.set_state(env.State.wait_for_brief_photo2of2)
+
     # Get the photo from the message
-    photo = await message.get_photo()
-    photo_bytesio = io.BytesIO(photo.body)
+    timer = await stg.StageTimer.load(state) # Continue the timings of the cover
+    photo = await timer.measure("brief_download", message.get_photo())
+    brief_filename = f"{message.from_user.id}/brief/{uuid.uuid4()}.jpg" # Generate a unique filename for the photo
 
-    # Get state
-    current_state = await state.get_state()
+    # Keep the photo for the VLM in the blob store, and only its key in the state
+    await blobs.put(brief_filename, photo.body)
+    if current_state == env.State.wait_for_brief_photo2of2:
+        await state.update_data(brief2_blob=brief_filename)
+    else:
+        await state.update_data(brief_blob=brief_filename)
 
     # -------------------------------------------------------
-    # Start the S3 client
-    session = aioboto3.Session()
-    async with session.client(service_name='s3', endpoint_url=com.AWS_ENDPOINT_URL) as s3:
-        # Upload the photo to S3 storage
-        try:
-            brief_filename = f"{message.from_user.id}/brief/{uuid.uuid4()}.jpg" # Generate a unique filename for the photo
-            await s3.upload_fileobj(photo_bytesio, com.AWS_BUCKET_NAME, brief_filename)
-            if current_state == env.State.wait_for_brief_photo2of2:
-                await state.update_data(brief2_filename=brief_filename) # Save the filename in the state
-                await state.update_data(brief2_base64 = base64.b64encode(photo_bytesio.getvalue()).decode('utf-8'))
-            else:
-                await state.update_data(brief_filename=brief_filename) # Save the filename in the state
-                await state.update_data(brief_base64 = base64.b64encode(photo_bytesio.getvalue()).decode('utf-8'))
-            await message.set_like() # Give like to user's photo
-        except Exception as e:
-            await message.reply(_("upload_failed"))
-            logging.error(f"Error uploading to S3: {e}")
+    # Upload the photo to S3 storage
+    async def upload_photo() -> str:
+        await timer.measure("brief_upload", s3.upload(photo.body, brief_filename))
+        return brief_filename
 
     # If we are waiting for the second brief photo, ask for it
     if current_state == env.State.wait_for_brief_photo1of2:
-        await eng.send_message(event_chat.id, _("photo_brief_2of2"))
-        await state.set_state(env.State.wait_for_brief_photo2of2)
+        upload_result, sent_message = await asyncio.gather(upload_photo(), eng.send_message(event_chat.id, _("photo_brief_2of2")), return_exceptions=True)
+        await save_upload(message, state, current_state, upload_result)
+        await timer.save(state)
+        if isinstance(sent_message, Exception):
+            raise sent_message
         return
 
     # Add temporal message for waiting
@@ -91,40 +152,19 @@ async def brief_photo(message: eng.Message, state: eng.FSMContext, event_chat: e
     else:
         waiting_message = await message.reply(_("wait"))
 
-    # Parse text on the photo using an Vision LLM
-    try:
-        # Prepare session for OpenAI API        
-        client = AsyncOpenAI(
-            api_key=com.GPT_API_TOKEN,
-            base_url=com.GPT_URL
-        )
-        # Ask GPT-4 Vision to analyze the image and extract book information
-        prompt = ""
-        for line in act.BOOK_PROMPT:
-            prompt = prompt + _(line) + "\n"
-        data = await state.get_data()
-        VLM_messages = [
-                {"role": "user", "content": [ {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{data.get("brief_base64")}"} } ] }
-            ]
-        if current_state == env.State.wait_for_brief_photo2of2:
-            VLM_messages = VLM_messages + [
-                    {"role": "user", "content": [ {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{data.get("brief2_base64")}"} } ] }
-                ]
-        VLM_messages = VLM_messages + [
-                {"role": "user", "content": [ {"type": "text", "text": prompt} ] }
-            ]
-        response = await client.chat.completions.create(
-            model=com.GPT_MODEL,
-            messages=VLM_messages,
-            max_tokens=2000
-        )
-    except Exception as e:
+    # Parse text on the photo using an Vision LLM, while the photo is uploading
+    upload_result, response = await asyncio.gather(upload_photo(), ask_vlm(state, current_state, timer), return_exceptions=True)
+    await save_upload(message, state, current_state, upload_result)
+
+    response_text = None
+    if isinstance(response, Exception):
         await message.reply(_("gpt_failed"))
-        logging.error(f"Error asking GPT: {e}")
+        logging.error(f"Error asking GPT: {response}")
+    else:
+        response_text = response.choices[0].message.content
     
     try:
         # Convert the response to a dictionary
-        response_text = response.choices[0].message.content
         book_dict = {}
         for line in response_text.splitlines():
             if "=" in line:
@@ -137,13 +177,27 @@ async def brief_photo(message: eng.Message, state: eng.FSMContext, event_chat: e
         if not book_dict:
             raise ValueError()        
     except Exception as e:
-        await message.reply(_("gpt_incorrect")+"\n"+response_text)
+        if response_text is not None:
+            await message.reply(_("gpt_incorrect")+"\n"+response_text)
         logging.error(f"Error parsing GPT response: {e}")
 
+    # The photos are not needed anymore
+    data = await state.get_data()
+    for key in ("brief_blob", "brief2_blob"):
+        if data.get(key):
+            await blobs.delete(data[key])
+    await state.update_data(brief_blob=None, brief2_blob=None, brief_base64=None, brief2_base64=None)
+
     # Remove temporal message
     await waiting_message.delete()
     # Print book info and ask user for reaction on brief
-    await AskForBriefReaction(message, state, event_chat)
+    await timer.measure("brief_send", AskForBriefReaction(message, state, event_chat))
+
+    # One record with all stages of the book
+    timer.log(platform=eng.MESSENGER.decode(), user_id=event_from_user.id,
+              brief_photos=2 if current_state == env.State.wait_for_brief_photo2of2 else 1,
+              recognized=bool(book_dict))
+    await state.update_data(**{stg.STATE_KEY: None})
 
 
 # =========================================================
@@ -5,21 +5,25 @@ from modules.engine import _  # For internationalization and localization
 import modules.actions as act # For bot commands and actions
 import modules.environment as env # For bot states and callback data factories
 import modules.common as com # For common functions and definitions
+import modules.cover_geometry as geo # For cutting the cover from the photo
+import modules.geometry_pool as gp # For running the geometry off the event loop
+import modules.s3storage as s3 # For uploading photos to S3 storage
+import modules.stages as stg # For timing the stages of adding a book
 
 import modules.h_brief as h_brief # For run brief commands
 
 import aiohttp # For HTTP requests to rembg service
+import asyncio # For waiting the rembg service in background
 import logging # For logging
+import math # For rounding the waiting time
 import numpy as np # For arrays processing
-import aioboto3 # For AWS S3 storage
-import io # For handling byte streams
-import uuid # For generating unique filenames
-import cv2 # For image processing
+import uuid # For generating unique filenames and request IDs
 
-# =========================================================
-# Calculate distance between two points
-def distance(p1, p2):
-    return np.sqrt((p1[0] - p2[0])**2 + (p1[1] - p2[1])**2)
+REMBG_TIMEOUT_sec = 120 # How long to wait for the cover, the rembg service drops the request after that
+STATUS_ATTEMPTS = 5 # How many times to ask rembg service for the position of our request
+STATUS_INTERVAL_sec = 0.1 # Interval between these attempts
+BUSY_TIMEOUT_sec = 1 # How long to wait for the queue state of rembg service
+PYRAMID_REFINE_px = 3 # How far from the scaled corners to look for the cover edges, in pixels of the downscaled photo
 
 # =========================================================
 # Ask user for the photo of the book cover
@@ -35,284 +39,205 @@ async def AskForCover(state: eng.FSMContext, event_chat: eng.Chat) -> None:
     # Set the state to wait for the cover text
     await state.set_state(env.State.wait_for_cover_photo)
 
+# =========================================================
+# Send the photo to rembg service and return corners of the cover found on it
+async def request_corners(http_session: aiohttp.ClientSession, photo_body: bytes, request_id: str) -> dict:
+    async with http_session.post(
+        f"{com.REMBG_URL}/cover?format=corners",
+        data=photo_body,
+        headers={"X-Request-ID": request_id, "X-Timeout": str(REMBG_TIMEOUT_sec)},
+        timeout=aiohttp.ClientTimeout(total=REMBG_TIMEOUT_sec),
+    ) as resp:
+        if resp.status == 422:
+            raise ValueError(_("contour_failed"))
+        if resp.status != 200:
+            raise Exception(f"rembg service error: {resp.status} {await resp.text()}")
+        cover_data = await resp.json()
+        cover_data["server_timing"] = parse_server_timing(resp.headers.get("Server-Timing"))
+        return cover_data
+
+# =========================================================
+# Parse Server-Timing header of rembg service to seconds of its stages
+def parse_server_timing(header: str | None) -> dict[str, float]:
+    timings = {}
+    for metric in (header or "").split(","):
+        name, _separator, params = metric.strip().partition(";")
+        for param in params.split(";"):
+            key, _equal, value = param.strip().partition("=")
+            if key == "dur":
+                try:
+                    timings[name] = float(value) / 1000
+                except ValueError:
+                    pass
+    return timings
+
+# =========================================================
+# Ask rembg service for the position and the estimated time of our request,
+# while the request is sent in background
+async def request_status(http_session: aiohttp.ClientSession, request_id: str, request_task: asyncio.Task) -> dict | None:
+    for _attempt in range(STATUS_ATTEMPTS):
+        if request_task.done():
+            return None
+        try:
+            async with http_session.get(f"{com.REMBG_URL}/queue/{request_id}") as resp:
+                if resp.status == 200:
+                    return await resp.json()
+        except Exception as e:
+            logging.warning(f"Error getting the queue status: {e}")
+            return None
+        # The request body may still be uploading, try later
+        await asyncio.sleep(STATUS_INTERVAL_sec)
+    return None
+
+# =========================================================
+# Is rembg service too busy to wait for it: long queue or long estimated time
+async def rembg_busy(http_session: aiohttp.ClientSession) -> bool:
+    try:
+        async with http_session.get(f"{com.REMBG_URL}/queue", timeout=aiohttp.ClientTimeout(total=BUSY_TIMEOUT_sec)) as resp:
+            resp.raise_for_status()
+            stats = await resp.json()
+    except Exception as e:
+        logging.warning(f"Error getting the queue state: {e}")
+        return True
+    return stats.get("queue_size", 0) >= com.REMBG_BUSY_QUEUE or (stats.get("eta_sec") or 0) >= com.REMBG_BUSY_ETA_sec
+
+# =========================================================
+# Make the text of the waiting message from the status of our request
+def waiting_text(status: dict | None) -> str:
+    if not status:
+        return _("wait")
+    position = status.get("position", 0)
+    eta = status.get("eta_sec")
+    if eta is None:
+        if position > 0:
+            return _("{wait}_in_queue","{wait}_in_queues",position).format(wait=position)
+        return _("wait")
+    seconds = max(1, math.ceil(eta))
+    if position > 0:
+        return _("{wait}_in_queue_{seconds}_sec","{wait}_in_queues_{seconds}_sec",position).format(wait=position, seconds=seconds)
+    return _("wait_{seconds}_sec").format(seconds=seconds)
+
 # =========================================================
 # Handler for sended photo of book cover
 @eng.on_message(eng.base_router, env.State.wait_for_cover_photo, eng.F_photo())
 @eng.message_handler
 async def cover_photo(message: eng.Message, state: eng.FSMContext, event_chat: eng.Chat, event_from_user: eng.User) -> None:
-    # Initialize variables for cleanup
-    photo_bytesio = None
-    photo_bytesio2 = None
-    output_bytesio = None
-    output_bytesio2 = None
     waiting_message = None
-    
-    # Variables for numpy arrays to cleanup
-    mask_np = None
-    mask_bw = None
-    binary_mask = None
-    kernel = None
-    original = None
-    warped = None
-    buffer = None
-    
-    try:
-        photo = await message.get_photo()
-        photo_bytesio = io.BytesIO(photo.body)
-        await state.update_data(photo_token=photo.token)
+    timer = stg.StageTimer() # New book starts from its cover
+    photo = await timer.measure("cover_download", message.get_photo())
+    await state.update_data(photo_token=photo.token)
 
-        # Start the S3 client
-        session = aioboto3.Session()
-        async with session.client(service_name='s3', endpoint_url=com.AWS_ENDPOINT_URL) as s3:
+    # -------------------------------------------------------
+    # Upload the photo to S3 storage
+    async def upload_photo() -> str:
+        photo_filename = f"{event_from_user.id}/photo/{uuid.uuid4()}.jpg" # Generate a unique filename for the photo
+        await timer.measure("photo_upload", s3.upload(photo.body, photo_filename))
+        return photo_filename
 
-            # -------------------------------------------------------
-            # Upload the photo to S3 storage
-            try:
-                photo_filename = f"{event_from_user.id}/photo/{uuid.uuid4()}.jpg" # Generate a unique filename for the photo
-                await s3.upload_fileobj(photo_bytesio, com.AWS_BUCKET_NAME, photo_filename)
-                await state.update_data(photo_filename=photo_filename) # Save the filename in the state
-                await message.set_like() # Give like to user's photo
-            except Exception as e:
-                await message.reply(_("upload_failed")+f" {e}")
-                logging.error(f"Error uploading to S3: {e}")
-            finally:
-                # Close BytesIO after upload
-                if photo_bytesio:
-                    photo_bytesio.close()
-                    photo_bytesio = None
-            
-            # Add temporal message for waiting
-            # Check queue size before processing
-            async with aiohttp.ClientSession() as http_session:
-                async with http_session.get(f"{com.REMBG_URL}/queue") as resp:
-                    queue_data = await resp.json()
-                    queue_size = queue_data.get("queue_size", 0)
-            if queue_size > 0:
-                waiting_message = await message.reply(_("{wait}_in_queue","{wait}_in_queues",queue_size).format(wait=queue_size))
-            else:
-                waiting_message = await message.reply(_("wait"))
+    # -------------------------------------------------------
+    # Find corners of the cover via rembg service, return them and the refine radius
+    async def find_corners_rembg(http_session: aiohttp.ClientSession) -> tuple[np.ndarray, int]:
+        nonlocal waiting_message
+        # Send a downscaled copy of the photo, the segmentation does not need all its pixels
+        body, full_size = photo.body, None
+        if com.REMBG_PYRAMID_SIDE > 0:
+            downscaled = await timer.measure("rembg_downscale", gp.run(geo.downscale_jpeg, photo.body, com.REMBG_PYRAMID_SIDE))
+            if downscaled:
+                body, full_size = downscaled
+        # Find corners of the cover via rembg service in background
+        request_id = uuid.uuid4().hex
+        request_task = asyncio.create_task(timer.measure("rembg", request_corners(http_session, body, request_id)))
+        try:
+            # Add temporal message for waiting with our own position in the queue
+            status = await request_status(http_session, request_id, request_task)
+            if not request_task.done():
+                waiting_message = await message.reply(waiting_text(status))
+            cover_data = await request_task
+        finally:
+            if not request_task.done():
+                request_task.cancel()
+        for name, seconds in cover_data["server_timing"].items():
+            timer.add(f"rembg_{name}", seconds)
+        rect = np.array(cover_data["corners"], dtype=np.float32)
+        if not full_size:
+            return rect, 0
+        # Scale the corners to the original photo and refine them on its edges
+        size = (cover_data["width"], cover_data["height"])
+        return geo.scale_corners(rect, size, full_size), math.ceil(PYRAMID_REFINE_px * full_size[0] / size[0]) + 2
 
-            # -------------------------------------------------------
-            # Remove the background from the image
+    # -------------------------------------------------------
+    # Find the cover on the photo and cut it
+    async def cut_cover() -> bytes:
+        http_session = eng.http_session()
+        # Try the local detector while asking rembg service how busy it is
+        local, busy = await asyncio.gather(timer.measure("local_detect", gp.run(geo.detect_cover, photo.body)),
+                                           timer.measure("rembg_state", rembg_busy(http_session)))
+        confidence = local[1] if local else 0.0
+        if confidence >= com.LOCAL_COVER_CONFIDENCE or (busy and confidence >= com.LOCAL_COVER_BUSY_CONFIDENCE):
+            logging.info(f"Cover found locally with confidence {confidence:.2f}, rembg busy: {busy}")
+            rect, refine_radius = local[0], 0
+        else:
             try:
-                # Remove background via rembg service
-                photo_bytesio = io.BytesIO(photo.body)
-                async with aiohttp.ClientSession() as http_session:
-                    async with http_session.post(
-                        f"{com.REMBG_URL}/remove?only_mask=true",
-                        data=photo_bytesio.getvalue(),
-                    ) as resp:
-                        if resp.status != 200:
-                            raise Exception(f"rembg service error: {resp.status} {await resp.text()}")
-                        mask_bytes = await resp.read()
-                
-                # Decode mask using cv2
-                mask_np = cv2.imdecode(np.frombuffer(mask_bytes, np.uint8), cv2.IMREAD_UNCHANGED)
-                del mask_bytes  # Free mask bytes immediately
-                
-                # Different models return different image format
-                if mask_np.ndim == 3 and mask_np.shape[2] == 4:
-                    # RGBA format - take only alpha channel
-                    mask_bw = mask_np[:, :, 3].copy()
-                elif mask_np.ndim == 3:
-                    # RGB format - convert to grayscale
-                    mask_bw = cv2.cvtColor(mask_np, cv2.COLOR_BGR2GRAY)
-                else:
-                    # Already grayscale
-                    mask_bw = mask_np.copy()
-                
-                # Free mask_np as we don't need it anymore
-                del mask_np
-                mask_np = None
-
-                # Convert to binary mask
-                _none, binary_mask = cv2.threshold(mask_bw, 127, 255, cv2.THRESH_BINARY)
-                
-                # Free mask_bw as we don't need it anymore
-                del mask_bw
-                mask_bw = None
-                
-                # Apply morphological operations to clean up the mask
-                kernel = np.ones((5, 5), np.uint8)
-                # Close small holes in the mask
-                binary_mask = cv2.morphologyEx(binary_mask, cv2.MORPH_CLOSE, kernel, iterations=2)
-                # Remove small noise outside the mask
-                binary_mask = cv2.morphologyEx(binary_mask, cv2.MORPH_OPEN, kernel, iterations=2)
-                
-                # Free kernel
-                del kernel
-                kernel = None
-
-                # Find contours
-                contours, _none = cv2.findContours(binary_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-                
-                # Free binary_mask as we don't need it anymore
-                del binary_mask
-                binary_mask = None
-                
-                if not contours:
-                    raise ValueError(_("contour_failed"))
-
-                # Find the largest contour
-                largest_contour = max(contours, key=cv2.contourArea)
-
-                # Approximate the contour to get a quadrilateral
-                quadrilateral = None
-
-                for factor in np.arange(0.02, 0.15, 0.005):
-                    epsilon = factor * cv2.arcLength(largest_contour, True)
-                    approx = cv2.approxPolyDP(largest_contour, epsilon, True)
-                    
-                    if len(approx) == 4:
-                        quadrilateral = approx
-                        break
-                    elif len(approx) < 4 and quadrilateral is None:
-                        # if just not found 4 points yet, save the best approximation
-                        quadrilateral = approx
-
-                # If no quadrilateral found, use minimum area rectangle arround the largest contour
-                if quadrilateral is None or len(quadrilateral) != 4:
-                    # Use minimum area rotated rectangle
-                    rect_tuple = cv2.minAreaRect(largest_contour)
-                    box = cv2.boxPoints(rect_tuple)
-                    quadrilateral = np.int0(box).reshape(-1, 1, 2)
-
-                # Free contours
-                del contours
-                del largest_contour
-
-                # Get quadrilateral points
-                pts = quadrilateral.reshape(4, 2).astype(np.float32)
-
-                # Order points: top-left, top-right, bottom-right, bottom-left
-                # First sort by sum of coordinates
-                rect = np.zeros((4, 2), dtype=np.float32)
-                s = pts.sum(axis=1)
-                rect[0] = pts[np.argmin(s)]  # top-left (min sum)
-                rect[2] = pts[np.argmax(s)]  # bottom-right (max sum)
-
-                # Remain two points sort by difference of coordinates
-                diff = np.diff(pts, axis=1)
-                rect[1] = pts[np.argmin(diff)]  # top-right (min difference)
-                rect[3] = pts[np.argmax(diff)]  # bottom-left (max difference)
-                
-                # Free intermediate arrays
-                del pts, s, diff, quadrilateral
+                rect, refine_radius = await find_corners_rembg(http_session)
+            except Exception as e:
+                # Better the local cover, than no cover
+                if confidence < com.LOCAL_COVER_BUSY_CONFIDENCE:
+                    raise
+                logging.warning(f"Error finding the cover via rembg, using the local one with confidence {confidence:.2f}: {e}")
+                rect, refine_radius = local[0], 0
 
-                # Compute width and height of the output quadrilateral
-                width_top = distance(rect[0], rect[1])
-                width_bottom = distance(rect[2], rect[3])
-                width = int(max(width_top, width_bottom))
+        # Cut the cover from the original photo
+        try:
+            cover, timings = await timer.measure("cover_cut", gp.run(geo.cut_cover_timed, photo.body, rect, refine_radius))
+        except ValueError:
+            raise ValueError(_("contour_failed"))
+        for name, seconds in timings.items():
+            timer.add(f"cover_{name}", seconds)
+        return cover
 
-                height_left = distance(rect[0], rect[3])
-                height_right = distance(rect[1], rect[2])
-                height = int(max(height_left, height_right))
+    # The upload and the cover detection do not depend on each other
+    photo_filename, output_bytes = await asyncio.gather(upload_photo(), cut_cover(), return_exceptions=True)
 
-                # Define orientation and create target quadrilateral
-                # If height is greater than width, then portrait orientation
-                if height > width:
-                    # Portrait orientation - swap width and height
-                    dst = np.array([
-                        [0, 0],
-                        [width - 1, 0],
-                        [width - 1, height - 1],
-                        [0, height - 1]
-                    ], dtype=np.float32)
-                    final_width, final_height = width, height
-                else:
-                    # Landscape orientation
-                    dst = np.array([
-                        [0, 0],
-                        [width - 1, 0],
-                        [width - 1, height - 1],
-                        [0, height - 1]
-                    ], dtype=np.float32)
-                    final_width, final_height = width, height
+    if isinstance(photo_filename, Exception):
+        await message.reply(_("upload_failed")+f" {photo_filename}")
+        logging.error(f"Error uploading to S3: {photo_filename}")
+    else:
+        await state.update_data(photo_filename=photo_filename) # Save the filename in the state
+        await message.set_like() # Give like to user's photo
 
-                # Compute perspective transformation matrix
-                M = cv2.getPerspectiveTransform(rect, dst)
-                
-                # Free rect and dst
-                del rect, dst
+    # Remove temporal message
+    if waiting_message:
+        await waiting_message.delete()
+        waiting_message = None
 
-                # Apply perspective transformation
-                original = cv2.imdecode(np.frombuffer(photo.body, np.uint8), cv2.IMREAD_COLOR)
-                warped = cv2.warpPerspective(original, M, (final_width, final_height))
-                
-                # Free original and M
-                del original, M
-                original = None
-                M = None
+    if isinstance(output_bytes, Exception):
+        await message.reply(_("remove_background_failed")+f" {output_bytes}")
+        logging.error(f"Error removing background: {output_bytes}")
+        return
 
-                is_success, buffer = cv2.imencode('.jpg', warped)
-                
-                # Free warped immediately after encoding
-                del warped
-                warped = None
-                
-                if is_success:
-                    output_bytesio = io.BytesIO(buffer.tobytes())
-                    # Free buffer
-                    del buffer
-                    buffer = None
-                else:
-                    raise ValueError(_("contour_failed"))
+    # -------------------------------------------------------
+    # Send the processed image back to the user, while it is uploading to S3 storage
+    cover_filename = f"{event_from_user.id}/cover/{uuid.uuid4()}.jpg" # Generate a unique filename for the photo
+    async def send_cover() -> eng.Message:
+        sent_message = await timer.measure("cover_send", eng.send_photo_from_bytes(event_chat.id, photo_bytes=output_bytes, filename=cover_filename))
+        await state.update_data(cover_token=sent_message.get_photo_token())
+        return sent_message
 
-            except Exception as e:
-                await message.reply(_("remove_background_failed")+f" {e}")
-                logging.error(f"Error removing background: {e}")
-                return
-            finally:
-                # Close photo_bytesio2
-                if photo_bytesio:
-                    photo_bytesio.close()
-                    photo_bytesio = None
-            
-            # -------------------------------------------------------
-            # Upload the processed image to S3 storage
-            try:
-                output_bytes = output_bytesio.getvalue()
-                output_bytesio2 = io.BytesIO(output_bytes)
-                cover_filename = f"{event_from_user.id}/cover/{uuid.uuid4()}.jpg" # Generate a unique filename for the photo
-                await s3.upload_fileobj(output_bytesio2, com.AWS_BUCKET_NAME, cover_filename)
-                await state.update_data(cover_filename=cover_filename) # Save the filename in the state
-            except Exception as e:
-                await message.reply(_("upload_failed")+f" {e}")
-                logging.error(f"Error uploading to S3: {e}")
-            finally:
-                # Close output_bytesio2
-                if output_bytesio2:
-                    output_bytesio2.close()
-                    output_bytesio2 = None
-            
-            # Remove temporal message
-            if waiting_message:
-                await waiting_message.delete()
-                waiting_message = None
+    upload_result, sent_message = await asyncio.gather(timer.measure("cover_upload", s3.upload(output_bytes, cover_filename)), send_cover(), return_exceptions=True)
+    if isinstance(upload_result, Exception):
+        await message.reply(_("upload_failed")+f" {upload_result}")
+        logging.error(f"Error uploading to S3: {upload_result}")
+    else:
+        await state.update_data(cover_filename=cover_filename) # Save the filename in the state
+    await timer.save(state) # The record of the book is written after its brief
+    if isinstance(sent_message, Exception):
+        raise sent_message
 
-            # -------------------------------------------------------
-            # Send the processed image back to the user
-            keyboard = []
-            for action in act.COVER_ACTIONS:
-                keyboard.append(eng.CallbackButton(text=_(action), payload=env.CoverActions(action=action) ))
-            output_bytes = output_bytesio.getvalue()
-            sent_message = await eng.send_photo_from_bytes(event_chat.id, photo_bytes=output_bytes, filename=cover_filename)
-            sent_cover = await sent_message.get_photo()
-            await state.update_data(cover_token=sent_cover.token)
-            await eng.send_inline_keyboard(sent_message, keyboard, state, 1, eng.onButtonClick.RemoveKeyboardKeepMessage)
-            await state.set_state(env.State.wait_reaction_on_cover)
-            
-    finally:
-        # Final cleanup - ensure all resources are freed
-        if photo_bytesio:
-            photo_bytesio.close()
-        if output_bytesio:
-            output_bytesio.close()
-        if output_bytesio2:
-            output_bytesio2.close()
-        
-        # Explicitly delete large numpy arrays
-        del mask_np, mask_bw, binary_mask, kernel, original, warped, buffer
+    keyboard = []
+    for action in act.COVER_ACTIONS:
+        keyboard.append(eng.CallbackButton(text=_(action), payload=env.CoverActions(action=action) ))
+    await eng.send_inline_keyboard(sent_message, keyboard, state, 1, eng.onButtonClick.RemoveKeyboardKeepMessage)
+    await state.set_state(env.State.wait_reaction_on_cover)
 
 
 # =========================================================
@@ -0,0 +1,151 @@
+# ========================================================
+# Module with a two-tier LRU store of bytes by key
+# ========================================================
+# A bounded in-memory LRU and an optional directory on local disk, both
+# evicting the least recently used entries when over their size limit.
+# Used by the blob store of the bot and by the result cache of rembg service.
+# ========================================================
+
+import os # For files
+import asyncio # For disk I/O off the event loop
+import hashlib # For file names of the keys
+import logging # For logging
+from collections import OrderedDict # For LRU order
+
+# ========================================================
+# Two-tier LRU store
+# ========================================================
+class LruStore:
+    """Bytes by key in memory (`memory_bytes`) and in `disk_dir` (`disk_bytes`, empty dir - memory only).
+    Files are named by the hash of the key, entries on disk survive restarts."""
+    def __init__(self, memory_bytes: int, disk_dir: str = "", disk_bytes: int = 0):
+        self.memory_limit = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_limit = disk_bytes if disk_dir else 0
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_size = 0
+        self._disk: OrderedDict[str, int] = OrderedDict()  # file name -> file size
+        self._disk_size = 0
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.evictions_memory = 0
+        self.evictions_disk = 0
+        if self.disk_limit:
+            self._load_disk_index()
+
+    def stats(self) -> dict:
+        return {
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "evictions_memory": self.evictions_memory,
+            "evictions_disk": self.evictions_disk,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_size,
+            "disk_entries": len(self._disk),
+            "disk_bytes": self._disk_size,
+        }
+
+    async def get(self, key: str) -> bytes | None:
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self.hits_memory += 1
+            return data
+        name = self._name(key)
+        if name in self._disk:
+            try:
+                data = await asyncio.to_thread(self._read_file, name)
+            except OSError as e:
+                logging.warning(f"Stored file of {key} is unreadable: {e}")
+                self._forget_file(name)
+                return None
+            self._disk.move_to_end(name)
+            self.hits_disk += 1
+            self._put_memory(key, data)
+            return data
+        return None
+
+    async def put(self, key: str, data: bytes) -> None:
+        self._put_memory(key, data)
+        if not self.disk_limit:
+            return
+        name = self._name(key)
+        try:
+            await asyncio.to_thread(self._write_file, name, data)
+        except OSError as e:
+            logging.warning(f"Cannot write stored file of {key}: {e}")
+            return
+        self._forget_file(name)
+        self._disk[name] = len(data)
+        self._disk_size += len(data)
+        while self._disk_size > self.disk_limit and len(self._disk) > 1:
+            old_name = next(iter(self._disk))
+            self._forget_file(old_name)
+            await asyncio.to_thread(self._remove_file, old_name)
+            self.evictions_disk += 1
+
+    async def delete(self, key: str) -> None:
+        data = self._memory.pop(key, None)
+        if data is not None:
+            self._memory_size -= len(data)
+        name = self._name(key)
+        if name in self._disk:
+            self._forget_file(name)
+            await asyncio.to_thread(self._remove_file, name)
+
+    def _put_memory(self, key: str, data: bytes) -> None:
+        if len(data) > self.memory_limit:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_size -= len(old)
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_limit:
+            _old_key, old = self._memory.popitem(last=False)
+            self._memory_size -= len(old)
+            self.evictions_memory += 1
+
+    # Disk tier helpers, the file operations run in a thread
+
+    @staticmethod
+    def _name(key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.disk_dir, name + ".bin")
+
+    def _load_disk_index(self) -> None:
+        os.makedirs(self.disk_dir, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.is_file() and entry.name.endswith(".bin"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for _mtime, name, size in sorted(files):
+            self._disk[name] = size
+            self._disk_size += size
+        logging.info(f"LRU store: {len(self._disk)} file(s), {self._disk_size} bytes in {self.disk_dir}")
+
+    def _forget_file(self, name: str) -> None:
+        self._disk_size -= self._disk.pop(name, 0)
+
+    def _read_file(self, name: str) -> bytes:
+        path = self._path(name)
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)  # Keep LRU order across restarts
+        return data
+
+    def _write_file(self, name: str, data: bytes) -> None:
+        # Write to a temporary file first, so a crash never leaves a truncated file
+        path = self._path(name)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def _remove_file(self, name: str) -> None:
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
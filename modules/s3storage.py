@@ -0,0 +1,84 @@
+# ========================================================
+# Module for uploading and downloading photos of S3 storage
+# ========================================================
+# One S3 client is opened at startup and shared by all handlers, so the
+# credentials, the endpoint and the connection pool are set up only once
+# instead of for every photo.
+# ========================================================
+
+import os # For environment variables
+import io # For handling byte streams
+import asyncio # For guarding the client creation
+import logging # For logging
+import contextlib # For keeping the client open between requests
+import aioboto3 # For AWS S3 storage
+from botocore.config import Config # For connection pool and retry settings
+
+import modules.common as com # For S3 endpoint and bucket
+
+# ========================================================
+# Configuration data
+# ========================================================
+
+# Connections kept open to the S3 endpoint
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "20"))
+# Attempts of every request, including the first one
+S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", "3"))
+# standard - exponential backoff with jitter, adaptive - also limits the rate on throttling
+S3_RETRY_MODE = os.getenv("S3_RETRY_MODE", "standard")
+S3_CONNECT_TIMEOUT_sec = int(os.getenv("S3_CONNECT_TIMEOUT", "5"))
+S3_READ_TIMEOUT_sec = int(os.getenv("S3_READ_TIMEOUT", "30"))
+
+# ========================================================
+# Environment variables
+# ========================================================
+
+client = None  # S3 client
+_stack: contextlib.AsyncExitStack | None = None  # Keeps the client context open
+_lock = asyncio.Lock()  # Only one client is created by concurrent first uploads
+
+# ========================================================
+# Open the S3 client
+# ========================================================
+async def init():
+    global client, _stack
+    async with _lock:
+        if client is None:
+            config = Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                            retries={"max_attempts": S3_MAX_ATTEMPTS, "mode": S3_RETRY_MODE},
+                            connect_timeout=S3_CONNECT_TIMEOUT_sec,
+                            read_timeout=S3_READ_TIMEOUT_sec,
+                            tcp_keepalive=True)
+            session = aioboto3.Session()
+            stack = contextlib.AsyncExitStack()
+            client = await stack.enter_async_context(session.client(service_name='s3', endpoint_url=com.AWS_ENDPOINT_URL, config=config))
+            _stack = stack
+            logging.info(f"S3 client: {S3_MAX_POOL_CONNECTIONS} connection(s), {S3_MAX_ATTEMPTS} attempt(s) in {S3_RETRY_MODE} mode")
+    return client
+
+# ========================================================
+# Upload bytes to the bucket under the given key
+# ========================================================
+async def upload(body: bytes, key: str) -> None:
+    s3 = client or await init()
+    with io.BytesIO(body) as fileobj:
+        await s3.upload_fileobj(fileobj, com.AWS_BUCKET_NAME, key)
+
+# ========================================================
+# Download bytes from the bucket by the key
+# ========================================================
+async def download(key: str) -> bytes:
+    s3 = client or await init()
+    response = await s3.get_object(Bucket=com.AWS_BUCKET_NAME, Key=key)
+    async with response["Body"] as stream:
+        return await stream.read()
+
+# ========================================================
+# Close the S3 client
+# ========================================================
+async def close() -> None:
+    global client, _stack
+    if _stack is not None:
+        await _stack.aclose()
+    client = None
+    _stack = None
@@ -0,0 +1,93 @@
+# ========================================================
+# Module for timing the stages of adding a book
+# ========================================================
+# Every handler of the add-book pipeline measures its stages (download,
+# upload, rembg, cut, VLM, ...) with a StageTimer. The durations of the
+# cover and the brief handlers are kept in the FSM state, and one log record
+# with all of them is written when the book is processed.
+# Histograms of the stages are exported to Prometheus when BOT_METRICS_PORT
+# is set and prometheus_client is installed.
+# ========================================================
+
+import os # For environment variables
+import time # For measuring time
+import json # For the structured log record
+import logging # For logging
+import contextlib # For the stage context manager
+
+try:
+    import prometheus_client # For exporting the histograms
+except ImportError:
+    prometheus_client = None
+
+# ========================================================
+# Configuration data
+# ========================================================
+
+# Port of Prometheus metrics of the bot (0 - disabled)
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "0"))
+
+STATE_KEY = "stage_seconds" # Key of the durations in the FSM state
+SECONDS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# ========================================================
+# Environment variables
+# ========================================================
+
+histogram = None  # Histogram of the stage durations, if exported
+
+# ========================================================
+# Start exporting the histograms
+# ========================================================
+def init() -> None:
+    global histogram
+    if histogram is not None or not BOT_METRICS_PORT:
+        return
+    if prometheus_client is None:
+        logging.warning("BOT_METRICS_PORT is set, but prometheus_client is not installed")
+        return
+    histogram = prometheus_client.Histogram("homelib_book_stage_seconds", "Duration of the stages of adding a book", ["stage"], buckets=SECONDS_BUCKETS)
+    prometheus_client.start_http_server(BOT_METRICS_PORT)
+    logging.info(f"Bot metrics on port {BOT_METRICS_PORT}")
+
+# ========================================================
+# Named stage timers of one book
+# ========================================================
+class StageTimer:
+    """Durations of the named stages in seconds, the durations of repeated stages are summed"""
+    def __init__(self, durations: dict | None = None):
+        self.durations = dict(durations or {})
+
+    @classmethod
+    async def load(cls, state) -> "StageTimer":
+        """Continue the timings of the book saved in the FSM state"""
+        data = await state.get_data()
+        durations = data.get(STATE_KEY)
+        return cls(durations if isinstance(durations, dict) else None)
+
+    async def save(self, state) -> None:
+        await state.update_data(**{STATE_KEY: self.durations})
+
+    def add(self, name: str, seconds: float) -> None:
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+        if histogram is not None:
+            histogram.labels(name).observe(seconds)
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Measure the block as the stage, also when it fails"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    async def measure(self, name: str, awaitable):
+        """Await the awaitable as the stage and return its result"""
+        with self.stage(name):
+            return await awaitable
+
+    def log(self, **fields) -> None:
+        """Write one structured record with all stage durations"""
+        record = {**fields, "stages": {name: round(seconds, 4) for name, seconds in self.durations.items()}}
+        logging.info(f"Book stages: {json.dumps(record, ensure_ascii=False)}")
@@ -0,0 +1,70 @@
+# ========================================================
+# Module for asking the Vision LLM
+# ========================================================
+# One OpenAI client is created at startup and shared by all handlers, so
+# the connections to the API are kept open between the books. Every request
+# has a deadline, retries with jittered exponential backoff (done by the
+# openai library, which also follows Retry-After of the API), and only
+# VLM_CONCURRENCY requests are sent at once, the others wait in turn.
+# ========================================================
+
+import os # For environment variables
+import asyncio # For the concurrency limit and the deadline
+import logging # For logging
+import httpx # For connection pool and timeout settings
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient # For OpenAI API client
+
+import modules.common as com # For API URL, token and model
+
+# ========================================================
+# Configuration data
+# ========================================================
+
+VLM_CONCURRENCY = int(os.getenv("VLM_CONCURRENCY", "4")) # Requests sent to the API at once
+VLM_MAX_CONNECTIONS = int(os.getenv("VLM_MAX_CONNECTIONS", "10")) # Connections kept open to the API
+VLM_MAX_RETRIES = int(os.getenv("VLM_MAX_RETRIES", "2")) # Retries of a failed request, after the first attempt
+VLM_CONNECT_TIMEOUT_sec = float(os.getenv("VLM_CONNECT_TIMEOUT", "10"))
+VLM_TIMEOUT_sec = float(os.getenv("VLM_TIMEOUT", "60")) # Timeout of one attempt
+VLM_DEADLINE_sec = float(os.getenv("VLM_DEADLINE", "120")) # Deadline of the request with waiting in turn and retries
+
+# ========================================================
+# Environment variables
+# ========================================================
+
+client: AsyncOpenAI | None = None  # OpenAI API client
+_semaphore = asyncio.Semaphore(VLM_CONCURRENCY)  # Limits the requests sent at once
+
+# ========================================================
+# Create the client
+# ========================================================
+def init() -> AsyncOpenAI:
+    global client
+    if client is None:
+        limits = httpx.Limits(max_connections=VLM_MAX_CONNECTIONS, max_keepalive_connections=VLM_MAX_CONNECTIONS)
+        client = AsyncOpenAI(api_key=com.GPT_API_TOKEN,
+                             base_url=com.GPT_URL,
+                             timeout=httpx.Timeout(VLM_TIMEOUT_sec, connect=VLM_CONNECT_TIMEOUT_sec),
+                             max_retries=VLM_MAX_RETRIES,
+                             http_client=DefaultAsyncHttpxClient(limits=limits))
+        logging.info(f"VLM client: {VLM_CONCURRENCY} request(s) at once, {VLM_MAX_RETRIES} retry(ies), deadline {VLM_DEADLINE_sec} sec")
+    return client
+
+# ========================================================
+# Send the messages to the model and return the completion
+# ========================================================
+async def complete(messages: list, max_tokens: int = 2000):
+    """Raise TimeoutError when the answer is not received before the deadline"""
+    api = client or init()
+    async def request():
+        async with _semaphore:
+            return await api.chat.completions.create(model=com.GPT_MODEL, messages=messages, max_tokens=max_tokens)
+    return await asyncio.wait_for(request(), VLM_DEADLINE_sec)
+
+# ========================================================
+# Close the client
+# ========================================================
+async def close() -> None:
+    global client
+    if client is not None:
+        await client.close()
+    client = None